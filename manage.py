@@ -4,14 +4,50 @@ import logging
 
 from flask.ext.script import Manager, Server
 
-from triager import app
-from triager.schedulers import RetrainScheduler
+from triager import app, db
+from triager.jobs import rollback_project
+from triager.models import Project, TrainStatus as TS, upgrade_schema
+from triager.schedulers import RetrainScheduler, notify_scheduler
 
 
 manager = Manager(app)
 manager.add_command('runserver', Server(host='0.0.0.0'))
 manager.add_command('runscheduler', RetrainScheduler())
 
+
+@manager.command
+def rollback(project_id):
+    """Publishes the previous version of the model of the project."""
+
+    version = rollback_project(project_id)
+    if version is None:
+        print("Project %s has no previous model version" % project_id)
+    else:
+        print("Project %s rolled back to model version %s"
+              % (project_id, version))
+
+
+@manager.command
+def upgrade():
+    """Upgrades the database created by an older version and queues training
+    of projects that have no model of this version.
+    """
+
+    for column in upgrade_schema():
+        print("Added column %s" % column)
+
+    projects = Project.query.filter(
+        Project.model_version == None,  # noqa
+        Project.train_status != TS.NOT_TRAINED)
+    for project in projects:
+        # The scheduler trains projects never trained before right away
+        project.train_status = TS.NOT_TRAINED
+        project.last_training = 0.0
+        db.session.add(project)
+        print("Project %s will be trained again" % project.id)
+    db.session.commit()
+    notify_scheduler()
+
 # Setup logging
 log_file = 'app.log'
 if 'runscheduler' in sys.argv:
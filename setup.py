@@ -15,6 +15,7 @@ setup(
     packages=find_packages(),
     install_requires=[
         'classifier>=0.1',
+        'nltk>=3.0',
         'Flask>=0.10.1',
         'Jinja2>=2.7.2',
         'sqlalchemy>=1.0.8',
@@ -27,6 +28,8 @@ setup(
         'requests>=2.7.0',
         'simplejson>=3.8.1',
         'numpy>=1.7.1',  # at least 1.8.0rc1 recommended
+        'scipy>=0.13.0',
+        'scikit-learn>=0.19',
     ],
     dependency_links=[
         'http://github.com/VaclavDedik/classifier/tarball/master#egg=classifier-0.1'
@@ -1,4 +1,6 @@
 from configuration import Configuration
+from cache import ModelCache, PredictionCache
+from metrics import Histogram
 
 from flask.ext.sqlalchemy import SQLAlchemy
 from flask.ext.login import LoginManager
@@ -10,6 +12,14 @@ app.config.from_envvar("TRIAGER_SETTINGS", silent=True)
 db = SQLAlchemy(app)
 login_manager = LoginManager()
 config = Configuration(app.config['STORAGE_FOLDER'])
+model_cache = ModelCache(app.config['MODEL_FOLDER'],
+                         app.config['MODEL_CACHE_SIZE'])
+prediction_cache = PredictionCache(app.config['PREDICTION_CACHE_SIZE'])
+prediction_metrics = Histogram(
+    "triager_prediction_seconds",
+    "Duration of phases of predictions of this web worker: loading of the "
+    "model, extraction of features and prediction.",
+    labels=("project", "phase"))
 
 import views  # noqa
 import models  # noqa
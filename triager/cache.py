@@ -0,0 +1,154 @@
+import os
+import joblib
+import logging
+import threading
+
+from collections import OrderedDict
+
+
+class ModelCache(object):
+    """In-process LRU cache of trained models.
+
+    Models are stored under the project id together with the version of the
+    model. Version of the published model of a project is kept in the
+    database, so when the version asked for differs from the cached one
+    (e.g. because the project was retrained), the cached model is discarded
+    and the requested version is loaded, without checking the model files on
+    every request. The total size of cached models is kept below
+    ``max_size`` bytes by evicting the least recently used models. Size of a
+    model is estimated by the size of its file, although the memory mapped
+    arrays of the model are held in the page cache of the system rather than
+    in the process.
+    """
+
+    MODEL_FILE = "svm.pkl"
+
+    def __init__(self, model_folder, max_size):
+        self.model_folder = model_folder
+        self.max_size = max_size
+        self.size = 0
+        self._models = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_model_path(self, project_id, version):
+        return os.path.join(self.model_folder, str(project_id), str(version),
+                            self.MODEL_FILE)
+
+    def get(self, project_id, version):
+        """Returns given version of trained model of the project or ``None``
+        if there is no such version.
+        """
+
+        if version is None:
+            return None
+
+        project_id = str(project_id)
+        with self._lock:
+            entry = self._models.get(project_id)
+            if entry and entry[0] == version:
+                # Mark as most recently used
+                del self._models[project_id]
+                self._models[project_id] = entry
+                return entry[2]
+
+        size, model = self._load(project_id, version)
+        if model is None:
+            return None
+
+        with self._lock:
+            self._remove(project_id)
+            self._models[project_id] = (version, size, model)
+            self.size += size
+            # Always keep at least the model that was just loaded
+            while self.size > self.max_size and len(self._models) > 1:
+                lru_id = next(iter(self._models))
+                logging.debug("Evicting model of project %s from cache"
+                              % lru_id)
+                self._remove(lru_id)
+
+        return model
+
+    def load(self, project_id, version):
+        """Returns given version of trained model of the project or ``None``
+        if there is no such version, without replacing the cached model of
+        the project. Intended for versions other than the published one,
+        which would otherwise evict the published model.
+        """
+
+        if version is None:
+            return None
+
+        project_id = str(project_id)
+        with self._lock:
+            entry = self._models.get(project_id)
+            if entry and entry[0] == version:
+                return entry[2]
+
+        return self._load(project_id, version)[1]
+
+    def evict(self, project_id):
+        with self._lock:
+            self._remove(str(project_id))
+
+    def _load(self, project_id, version):
+        logging.debug("Loading model %s of project %s"
+                      % (version, project_id))
+        model_path = self.get_model_path(project_id, version)
+        try:
+            size = os.path.getsize(model_path)
+            # Arrays of the model are memory mapped, so they are loaded
+            # lazily and shared with other processes that use the same model
+            return size, joblib.load(model_path, mmap_mode='r')
+        except (IOError, OSError):
+            logging.warning("Model %s of project %s does not exist"
+                            % (version, project_id))
+            return None, None
+
+    def _remove(self, project_id):
+        entry = self._models.pop(project_id, None)
+        if entry:
+            self.size -= entry[1]
+
+
+class PredictionCache(object):
+    """In-process LRU cache of predictions.
+
+    Predictions are stored under the digest of the predicted document (see
+    :meth:`models.Feedback.get_id_from_doc`) and the version of the model
+    that predicted them, so predictions of a retrained model never hit
+    predictions of the previous one, which are then evicted as least
+    recently used. At most ``max_size`` predictions are kept, each of them
+    with ``n`` most likely labels.
+    """
+
+    def __init__(self, max_size, n=10):
+        self.max_size = max_size
+        self.n = n
+        self._predictions = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, digest, version):
+        """Returns list of ``(label, score)`` tuples predicted for the
+        document, or ``None`` if the prediction is not cached. The list is
+        empty if the document contains no known features.
+        """
+
+        key = (digest, version)
+        with self._lock:
+            scores = self._predictions.pop(key, None)
+            if scores is not None:
+                # Mark as most recently used
+                self._predictions[key] = scores
+            return scores
+
+    def put(self, digest, version, scores):
+        """Stores ``n`` most likely labels of the prediction, ``scores`` is
+        ``None`` if the document contains no known features.
+        """
+
+        key = (digest, version)
+        with self._lock:
+            self._predictions.pop(key, None)
+            self._predictions[key] = list(scores or [])[:self.n]
+            while len(self._predictions) > self.max_size:
+                self._predictions.popitem(last=False)
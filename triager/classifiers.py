@@ -0,0 +1,393 @@
+import numpy as np
+
+from nltk.corpus import stopwords
+from scipy import sparse
+from sklearn.feature_extraction.text import CountVectorizer
+from sklearn.linear_model import SGDClassifier
+from sklearn.preprocessing import normalize
+from sklearn.svm import SVC
+
+
+#: English stop words of NLTK, the same that the models of the classifier
+#: library removed
+STOP_WORDS = frozenset(stopwords.words('english'))
+
+#: Longer terms (e.g. parts of stack traces, URLs or base64 data) are
+#: ignored, they would widen every item of the fixed-width arrays of terms
+MAX_TERM_LENGTH = 40
+
+_analyze = CountVectorizer(stop_words=STOP_WORDS).build_analyzer()
+
+
+def analyze(text):
+    """Splits text into terms and removes stop words and too long terms."""
+
+    return [term for term in _analyze(text) if len(term) <= MAX_TERM_LENGTH]
+
+
+def get_text(document):
+    title = document.title if document.title else ""
+    content = document.content if document.content else ""
+    return title + "\n" + content
+
+
+class TermCounts(object):
+    """Term counts of a list of labeled documents.
+
+    Documents are tokenized and stop words removed only once. Features of
+    models trained on the whole list or any part of it are then derived from
+    the counts without touching the text of the documents again.
+    """
+
+    def __init__(self, documents):
+        vectorizer = CountVectorizer(analyzer=analyze)
+        self.counts = vectorizer.fit_transform(
+            [get_text(doc) for doc in documents]).tocsr()
+
+        vocabulary = vectorizer.vocabulary_
+        self.terms = sorted(vocabulary, key=vocabulary.get)
+        self.labels = np.array([doc.label for doc in documents], dtype=object)
+
+    def __len__(self):
+        return self.counts.shape[0]
+
+
+class TFIDFFeatures(object):
+    """TF-IDF weighed features with stop words removal. Vocabulary and
+    document frequencies are taken from the documents of term counts at
+    given indices.
+
+    Vocabulary is kept in a sorted array of UTF-8 encoded terms rather than
+    in a dictionary, so that it is memory mapped together with the other
+    arrays of a model loaded with ``mmap_mode``. Items of the array are as
+    wide as the longest term, which is at most ``MAX_TERM_LENGTH``
+    characters.
+    """
+
+    def __init__(self, term_counts, indices):
+        counts = term_counts.counts[indices]
+        n = counts.shape[0]
+        df = np.bincount(counts.indices, minlength=counts.shape[1])
+
+        # Only terms that occur in the selected documents are used
+        columns = np.flatnonzero(df)
+        terms = np.array([term_counts.terms[column].encode("utf-8")
+                          for column in columns], dtype=np.bytes_)
+        order = np.argsort(terms)
+        self.columns = columns[order]
+        self.terms = terms[order]
+        self.n = n
+        self.df = df[self.columns]
+        self._update_idf()
+
+    def transform(self, documents):
+        """Returns sparse feature matrix of the documents."""
+
+        return self._weigh(self._count(documents))
+
+    def update(self, documents):
+        """Adds the documents to document frequencies of the terms and
+        returns their sparse feature matrix. Terms that are not in the
+        vocabulary are ignored.
+        """
+
+        counts = self._count(documents)
+        self.n += counts.shape[0]
+        self.df = self.df + np.bincount(
+            counts.indices, minlength=len(self.terms))
+        self._update_idf()
+        return self._weigh(counts)
+
+    def select(self, term_counts, indices):
+        """Returns sparse feature matrix of documents of the term counts at
+        given indices.
+        """
+
+        counts = term_counts.counts[indices][:, self.columns]
+        return self._weigh(counts)
+
+    def _update_idf(self):
+        self.idf = np.log((1.0 + self.n) / (1.0 + self.df)) + 1.0
+
+    def _count(self, documents):
+        indices = []
+        indptr = [0]
+        for doc in documents:
+            tokens = np.array([token.encode("utf-8")
+                               for token in analyze(get_text(doc))],
+                              dtype=np.bytes_)
+            positions = np.searchsorted(self.terms, tokens)
+            known = positions < len(self.terms)
+            known[known] = self.terms[positions[known]] == tokens[known]
+            indices.append(positions[known])
+            indptr.append(indptr[-1] + len(indices[-1]))
+
+        indices = np.concatenate(indices) if indices else []
+        counts = sparse.csr_matrix(
+            (np.ones(len(indices)), indices, indptr),
+            shape=(len(documents), len(self.terms)))
+        counts.sum_duplicates()
+        return counts
+
+    def _weigh(self, counts):
+        X = counts.astype(np.float64) * sparse.diags(self.idf, 0)
+        return normalize(X.tocsr())
+
+
+def squared_norms(X):
+    """Returns squared norms of rows of the sparse matrix."""
+
+    return np.asarray(X.multiply(X).sum(axis=1)).ravel()
+
+
+def gaussian_kernel(X, X_norms, Y, Y_norms, gamma):
+    """Returns dense matrix of Gaussian kernel between rows of sparse
+    matrices ``X`` and ``Y`` computed from their sparse dot products and
+    squared norms of their rows, so the rows are never made dense.
+    """
+
+    # exp(-gamma * |x - y|^2), where |x - y|^2 = |x|^2 + |y|^2 - 2 * x.y
+    K = (X * Y.T).toarray()
+    K *= 2.0
+    K -= X_norms[:, np.newaxis]
+    K -= Y_norms[np.newaxis, :]
+    # Rounding errors must not make distances negative
+    np.minimum(K, 0.0, out=K)
+    K *= gamma
+    return np.exp(K, out=K)
+
+
+class Model(object):
+    """Base of models that predict labels of documents from their TF-IDF
+    features.
+
+    Besides predicting labels of a single document, the model can predict
+    labels of a whole batch of documents at once, in which case the feature
+    extraction and evaluation of the classifier are done only once for the
+    batch.
+    """
+
+    #: The trained model can be updated by :meth:`update`
+    updatable = False
+
+    def __init__(self):
+        self.features = None
+        self.clf = None
+
+    def train(self, data):
+        """Trains the model on given list of labeled documents."""
+
+        self.train_counts(TermCounts(data))
+
+    def train_counts(self, term_counts, indices=None):
+        """Trains the model on documents of term counts at given indices, or
+        on all the documents if no indices are given.
+        """
+
+        raise NotImplementedError()
+
+    def update(self, data):
+        """Updates the trained model by given list of labeled documents
+        without training it again. Documents labeled by labels the model
+        does not know are ignored.
+        """
+
+        raise NotImplementedError()
+
+    def predict(self, document, n=1):
+        """Returns list of ``n`` most likely labels of the document.
+
+        :raises ValueError: If the document contains no known features.
+        """
+
+        scores = self.predict_scores([document], n=n)[0]
+        if scores is None:
+            raise ValueError("Document contains no known features")
+
+        return [label for label, _ in scores]
+
+    def predict_scores(self, documents, n=1):
+        """Predicts ``n`` most likely labels of each of the documents.
+
+        :returns: List that contains a list of ``(label, score)`` tuples
+                  sorted by score for each document, or ``None`` if the
+                  document contains no known features.
+        """
+
+        return self._predict_scores(self.transform(documents), n)
+
+    def predict_scores_features(self, X, n=1):
+        """Same as :meth:`predict_scores`, but predicts labels of documents
+        of given feature matrix (see :meth:`transform`).
+        """
+
+        return self._predict_scores(X, n)
+
+    def transform(self, documents):
+        """Returns sparse feature matrix of the documents."""
+
+        return self.features.transform(documents)
+
+    def predict_scores_counts(self, term_counts, indices, n=1):
+        """Same as :meth:`predict_scores`, but predicts labels of documents
+        of term counts at given indices.
+        """
+
+        X = self.features.select(term_counts, indices)
+        return self._predict_scores(X, n)
+
+    def _predict_scores(self, X, n):
+        known = np.flatnonzero(np.diff(X.indptr))
+
+        results = [None] * X.shape[0]
+        if not len(known):
+            return results
+
+        scores = self._decision_function(X[known])
+        if scores.ndim == 1:
+            # Binary classification, score is positive for the second class
+            scores = np.column_stack([-scores, scores])
+
+        classes = self.clf.classes_
+        for i, doc_scores in zip(known, scores):
+            best = np.argsort(doc_scores)[::-1][:n]
+            results[i] = [(classes[j], float(doc_scores[j])) for j in best]
+
+        return results
+
+    def _decision_function(self, X):
+        return self.clf.decision_function(X)
+
+    def details(self):
+        """Returns dictionary with labels and number of features of the
+        trained model and whether it can be updated.
+        """
+
+        return dict(labels=self.clf.classes_.tolist(),
+                    feature_count=len(self.features.columns),
+                    updatable=self.updatable)
+
+
+class SVMModel(Model):
+    """Support Vector Machine model with TF-IDF weighing, stop words removal
+    and Gaussian kernel.
+
+    Kernel is computed from sparse feature vectors of the documents (see
+    :func:`gaussian_kernel`) and passed to the SVM precomputed. Only feature
+    vectors of support vectors are kept for prediction. Both the time and
+    memory needed to train the model grow quadratically with the number of
+    documents.
+    """
+
+    def __init__(self, C=1.0, gamma=1.0, cache_size=200):
+        super(SVMModel, self).__init__()
+        self.C = C
+        self.gamma = gamma
+        self.cache_size = cache_size
+
+        self.train_size = None
+        self.support_vectors = None
+        self.support_norms = None
+
+    def train_counts(self, term_counts, indices=None):
+        """Trains the model on documents of term counts at given indices, or
+        on all the documents if no indices are given.
+        """
+
+        if indices is None:
+            indices = np.arange(len(term_counts))
+
+        self.features = TFIDFFeatures(term_counts, indices)
+        X = self.features.select(term_counts, indices)
+        y = term_counts.labels[indices]
+
+        norms = squared_norms(X)
+        K = gaussian_kernel(X, norms, X, norms, self.gamma)
+
+        self.clf = SVC(C=self.C, kernel='precomputed',
+                       cache_size=self.cache_size,
+                       decision_function_shape='ovr')
+        self.clf.fit(K, y)
+
+        self.train_size = X.shape[0]
+        self.support_vectors = X[self.clf.support_]
+        self.support_norms = norms[self.clf.support_]
+
+    def _decision_function(self, X):
+        # Precomputed kernel must have a column for every training document,
+        # but only the columns of support vectors are used
+        K = np.zeros((X.shape[0], self.train_size))
+        K[:, self.clf.support_] = gaussian_kernel(
+            X, squared_norms(X), self.support_vectors, self.support_norms,
+            self.gamma)
+        return self.clf.decision_function(K)
+
+    def details(self):
+        """Returns dictionary with labels, number of features and number of
+        support vectors of the trained model.
+        """
+
+        details = super(SVMModel, self).details()
+        details['support_vector_count'] = len(self.clf.support_)
+        return details
+
+    def __str__(self):
+        return "SVMModel(C=%s, gamma=%s, cache_size=%s)" \
+            % (self.C, self.gamma, self.cache_size)
+
+
+class LinearModel(Model):
+    """Linear Support Vector Machine model with TF-IDF weighing and stop words
+    removal. One classifier per label is trained by stochastic gradient
+    descent, so the time needed to train the model grows linearly with the
+    number of documents.
+    """
+
+    updatable = True
+
+    def __init__(self, alpha=0.0001, max_iter=20):
+        super(LinearModel, self).__init__()
+        self.alpha = alpha
+        self.max_iter = max_iter
+
+    def train_counts(self, term_counts, indices=None):
+        """Trains the model on documents of term counts at given indices, or
+        on all the documents if no indices are given.
+        """
+
+        if indices is None:
+            indices = np.arange(len(term_counts))
+
+        self.features = TFIDFFeatures(term_counts, indices)
+        X = self.features.select(term_counts, indices)
+        y = term_counts.labels[indices]
+
+        self.clf = SGDClassifier(loss='hinge', alpha=self.alpha,
+                                 max_iter=self.max_iter, tol=None,
+                                 random_state=0)
+        self.clf.fit(X, y)
+
+    def update(self, data):
+        """Updates the trained model by given list of labeled documents
+        without training it again. Document frequencies of the terms are
+        updated and one pass of stochastic gradient descent is made over the
+        documents. Documents labeled by labels the model does not know are
+        ignored.
+        """
+
+        labels = set(self.clf.classes_)
+        data = [doc for doc in data if doc.label in labels]
+        if not data:
+            return
+
+        X = self.features.update(data)
+        y = np.array([doc.label for doc in data], dtype=object)
+
+        # Documents without any known features would only move intercepts
+        known = np.flatnonzero(np.diff(X.indptr))
+        if len(known):
+            self.clf.partial_fit(X[known], y[known])
+
+    def __str__(self):
+        return "LinearModel(alpha=%s, max_iter=%s)" \
+            % (self.alpha, self.max_iter)
@@ -6,9 +6,33 @@ from utils import hash_pwd
 
 
 class Configuration(object):
+    """Configuration stored in file *settings.cfg* in the configuration
+    directory. Options are accessed as attributes named *section__option*.
+
+    The file is parsed only when it changes, values of options are parsed
+    only once after that. Numeric options are converted to their types.
+    """
+
+    #: Types of numeric options
+    TYPES = {
+        'general__ticket_limit': int,
+        'general__min_class_occur': int,
+        'svm__coefficient': float,
+        'svm__cache_size': int,
+        'linear__ticket_limit': int,
+    }
+
+    #: Default values of options that may be missing in configuration files
+    #: created by older versions
+    DEFAULTS = {
+        'linear__ticket_limit': "100000",
+    }
+
     def __init__(self, config_dir):
         self.config_file = os.path.join(config_dir, "settings.cfg")
         self.config = SafeConfigParser()
+        self.file_stat = None
+        self.values = {}
 
         if os.path.isfile(self.config_file):
             self.reload()
@@ -18,9 +42,29 @@ class Configuration(object):
     def save(self):
         with open(self.config_file, 'w') as f:
             self.config.write(f)
+        self.file_stat = self._get_file_stat()
 
     def reload(self):
-        self.config.read([self.config_file])
+        """Reads the configuration file again if it changed since it was
+        last read or saved.
+        """
+
+        file_stat = self._get_file_stat()
+        if file_stat is None or file_stat == self.file_stat:
+            return
+
+        config = SafeConfigParser()
+        config.read([self.config_file])
+        self.config = config
+        self.file_stat = file_stat
+        self.values = {}
+
+    def _get_file_stat(self):
+        try:
+            stat = os.stat(self.config_file)
+        except OSError:
+            return None
+        return (stat.st_mtime, stat.st_size)
 
     def _setup_config(self):
         self.general__ticket_limit = "3000"
@@ -31,6 +75,8 @@ class Configuration(object):
         self.svm__coefficient = "240.0"
         self.svm__cache_size = "2000"
 
+        self.linear__ticket_limit = self.DEFAULTS['linear__ticket_limit']
+
         self.jira__default_resolutions = "Fixed"
         self.jira__default_statuses = "Resolved,Closed"
 
@@ -39,13 +85,26 @@ class Configuration(object):
         self.save()
 
     def __getattr__(self, name):
+        values = self.__dict__.get('values', {})
+        if name in values:
+            return values[name]
+
         section_option = name.split("__", 1)
         if len(section_option) == 2 and section_option[0]:
             section, option = section_option
 
+            value = None
             if self.config.has_section(section) \
                     and self.config.has_option(section, option):
-                return self.config.get(section, option)
+                value = self.config.get(section, option)
+            elif name in self.DEFAULTS:
+                value = self.DEFAULTS[name]
+
+            if value is not None:
+                if name in self.TYPES:
+                    value = self.TYPES[name](value)
+                values[name] = value
+                return value
 
         raise AttributeError("%s has no attribute '%s'"
                              % (self.__class__.__name__, name))
@@ -60,7 +119,8 @@ class Configuration(object):
 
             if name != "auth__admin" or value:
                 self.config.set(section, option, str(value))
-        elif name in ['config_file', 'config']:
+                self.values.pop(name, None)
+        elif name in ['config_file', 'config', 'file_stat', 'values']:
             super(Configuration, self).__setattr__(name, value)
         else:
             raise AttributeError("%s has no attribute '%s'"
@@ -0,0 +1,110 @@
+import time
+import logging
+import multiprocessing
+import numpy as np
+
+from sklearn import metrics
+
+
+def _top_labels(predictions):
+    # Documents without any known features are never predicted correctly,
+    # empty label is used for them so that labels stay of a single type.
+    return [scores[0][0] if scores else "" for scores in predictions]
+
+
+def _scores(y_true, y_pred):
+    labels = sorted(set(y_true))
+    accuracy = metrics.accuracy_score(y_true, y_pred)
+    precision = metrics.precision_score(
+        y_true, y_pred, labels=labels, average='macro')
+    recall = metrics.recall_score(
+        y_true, y_pred, labels=labels, average='macro')
+    return accuracy, precision, recall
+
+
+def evaluate(model, term_counts, indices):
+    """Returns tuple of accuracy, precision and recall of the model on
+    documents of term counts at given indices.
+    """
+
+    y_true = list(term_counts.labels[indices])
+    y_pred = _top_labels(model.predict_scores_counts(term_counts, indices))
+    return _scores(y_true, y_pred)
+
+
+def stratified_folds(labels, k, seed=None):
+    """Randomly splits indices of labels into ``k`` folds so that every label
+    is spread evenly among the folds.
+
+    :returns: List of ``k`` sorted arrays of indices.
+    """
+
+    random_state = np.random.RandomState(seed)
+    folds = [[] for _ in range(k)]
+    offset = 0
+    for label in sorted(set(labels)):
+        indices = np.flatnonzero(labels == label)
+        random_state.shuffle(indices)
+        for i, index in enumerate(indices):
+            folds[(offset + i) % k].append(index)
+        # Do not start every label in the first fold
+        offset += len(indices)
+
+    return [np.array(sorted(fold), dtype=int) for fold in folds]
+
+
+def _evaluate_fold(model, term_counts, indices_train, indices_test):
+    model.train_counts(term_counts, indices_train)
+    return evaluate(model, term_counts, indices_test)
+
+
+def cross_validate(model, term_counts, k=5, seed=None, processes=1,
+                   timeout=None):
+    """Evaluates the model by stratified k-fold cross-validation on documents
+    of the term counts. Folds are trained in parallel by a pool of
+    ``processes`` processes. Folds that are not evaluated within ``timeout``
+    seconds are skipped, the pool is terminated when the timeout expires,
+    so a fold is never evaluated past it. The pool is used for a timeout
+    even if there is only one process. In a daemonic process, which cannot
+    start a pool, folds are evaluated one by one and the timeout is only
+    checked between them, so it does not cut a running fold short.
+
+    :returns: List of tuples of accuracy, precision and recall of each of the
+              evaluated folds.
+    """
+
+    all_indices = np.arange(len(term_counts))
+    tasks = [(model, term_counts, np.setdiff1d(all_indices, fold), fold)
+             for fold in stratified_folds(term_counts.labels, k, seed)]
+    deadline = time.time() + timeout if timeout else None
+
+    results = []
+    # Daemonic processes (e.g. workers of a pool) cannot have children
+    use_pool = processes > 1 or deadline is not None
+    if use_pool and not multiprocessing.current_process().daemon:
+        pool = multiprocessing.Pool(processes=min(processes, k))
+        try:
+            pending = [pool.apply_async(_evaluate_fold, task)
+                       for task in tasks]
+            for result in pending:
+                remaining = None
+                if deadline is not None:
+                    remaining = max(deadline - time.time(), 0)
+                try:
+                    results.append(result.get(remaining))
+                except multiprocessing.TimeoutError:
+                    break
+        finally:
+            pool.terminate()
+            pool.join()
+    else:
+        for task in tasks:
+            if deadline is not None and time.time() >= deadline:
+                break
+            results.append(_evaluate_fold(*task))
+
+    if len(results) < k:
+        logging.warning("Cross-validation ran out of time, only %s of %s "
+                        "folds evaluated" % (len(results), k))
+
+    return results
@@ -2,7 +2,7 @@ import time
 
 from flask_wtf import Form
 from wtforms import StringField, IntegerField, SelectField, FloatField
-from wtforms import PasswordField
+from wtforms import PasswordField, HiddenField
 from wtforms.validators import DataRequired, Length, NumberRange, URL
 from wtforms.validators import ValidationError, InputRequired
 from wtforms.widgets import TextArea
@@ -11,6 +11,7 @@ from croniter import croniter
 from triager import config
 from triager import auth
 from triager import jira
+from models import ModelType
 
 
 #
@@ -82,6 +83,21 @@ class ProjectForm(Form):
                     "'http://www.nncron.ru/help/EN/working/cron-format.htm'."
     )
 
+    model_type = SelectField(
+        'Model Type',
+        choices=[
+            (ModelType.SVM, "Gaussian SVM"),
+            (ModelType.LINEAR, "Linear SVM"),
+        ],
+        default=ModelType.SVM,
+        description="Gaussian SVM is usually more accurate, but its training "
+                    "takes a lot of time and memory, so it can use only a "
+                    "few thousands of tickets (see ticket limit in settings). "
+                    "Linear SVM trains quickly even on hundreds of thousands "
+                    "of tickets, so choose it for projects with large "
+                    "history of tickets."
+    )
+
 
 class DataSourceForm(Form):
     pass
@@ -154,6 +170,10 @@ class IssueForm(Form):
 class FeedbackForm(IssueForm):
     selected_recommendation = IntegerField(default=0)
     confirmed_recommendation = IntegerField(default=0)
+    #: Version of the model that recommended the assignees and the confirmed
+    #: assignee
+    model_version = HiddenField()
+    confirmed_assignee = HiddenField()
 
 
 class ConfigurationForm(Form):
@@ -220,6 +240,19 @@ class ConfigurationForm(Form):
                     "this unless you are really sure what you are doing."
     )
 
+    linear__ticket_limit = IntegerField(
+        'Linear SVM ticket limit',
+        validators=[
+            InputRequired(),
+            NumberRange(min=1000)
+        ],
+        description="Maximum number of tickets/issues/bugs that the "
+                    "Triager will use for training of projects with Linear "
+                    "SVM model. Time needed to train the model grows only "
+                    "linearly with the number of tickets, so values of "
+                    "100000 and more are reasonable."
+    )
+
     svm__cache_size = IntegerField(
         'SVM cache limit',
         validators=[
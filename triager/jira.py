@@ -1,11 +1,50 @@
+import time
+import logging
 import requests
 
+from itertools import islice
+from collections import deque
+from multiprocessing.pool import ThreadPool
+from requests.adapters import HTTPAdapter
+
 
 class Jira(object):
-    def __init__(self, url):
+    def __init__(self, url, concurrency=1, retries=0, retry_delay=1.0,
+                 timeout=60):
+        """Creates Jira REST API client.
+
+        :param url: URL of the Jira REST API.
+        :param concurrency: Maximum number of pages downloaded in parallel.
+        :param retries: How many times a failed request is retried.
+        :param retry_delay: Delay in seconds before the first retry, the
+                            delay is doubled with every other retry.
+        :param timeout: Timeout of a single request in seconds.
+        """
+
         self.url = url
+        self.concurrency = max(concurrency, 1)
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.timeout = timeout
+
+        #: Number of pages downloaded by :meth:`iter_all`
+        self.page_count = 0
+
+        # Keep-alive connections shared by all threads
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_maxsize=self.concurrency)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
 
     def find_all(self, jql, fields=None, offset=0, limit=1000):
+        return list(self.iter_all(jql, fields, offset=offset, limit=limit))
+
+    def iter_all(self, jql, fields=None, offset=0, limit=1000):
+        """Yields issues matching the JQL query. Issues are downloaded page by
+        page, so only the pages that are being downloaded in parallel are
+        held in memory.
+        """
+
         # Prepare request url
         get_url = self.url
         if not get_url.endswith("/"):
@@ -24,29 +63,72 @@ class Jira(object):
 
         # Execute request
         result = self.get_request(get_url_wlimit)
-        issues = result['issues']
+        self.page_count += 1
+        page_urls = []
 
         # Partition if offset on server limited
-        if result['maxResults'] < limit:
+        if 0 < result['maxResults'] < limit:
             new_limit = result['maxResults']
-            new_offset = offset + new_limit
-            total = result['total']
-
-            while new_offset < limit and new_offset < total:
-                new_get_url = get_url + "&startAt=%s&maxResults=%s" \
-                    % (new_offset, new_limit)
-                curr_result = self.get_request(new_get_url)
-                issues += curr_result['issues']
-                new_offset += new_limit
-
-        return issues
+            end = min(limit, result['total'])
+            page_urls = [
+                get_url + "&startAt=%s&maxResults=%s" % (new_offset, new_limit)
+                for new_offset in range(offset + new_limit, end, new_limit)]
+
+        for issue in result['issues']:
+            yield issue
+        del result
+
+        for page in self._iter_pages(page_urls):
+            self.page_count += 1
+            for issue in page['issues']:
+                yield issue
+
+    def _iter_pages(self, page_urls):
+        if self.concurrency == 1 or len(page_urls) < 2:
+            for page_url in page_urls:
+                yield self.get_request(page_url)
+            return
+
+        pool = ThreadPool(min(self.concurrency, len(page_urls)))
+        try:
+            # Download at most as many pages ahead as there are threads.
+            # Pages are returned in order, even if fetched in parallel.
+            urls = iter(page_urls)
+            pending = deque(pool.apply_async(self.get_request, (page_url,))
+                            for page_url in islice(urls, self.concurrency))
+            while pending:
+                page = pending.popleft().get()
+                page_url = next(urls, None)
+                if page_url:
+                    pending.append(
+                        pool.apply_async(self.get_request, (page_url,)))
+                yield page
+        finally:
+            pool.terminate()
 
     def get_request(self, url):
-        r = requests.get(url)
-        if not r.ok:
-            r.raise_for_status()
-
-        return r.json()
+        attempt = 0
+        while True:
+            try:
+                r = self.session.get(url, timeout=self.timeout)
+                if not r.ok:
+                    r.raise_for_status()
+
+                return r.json()
+            except requests.RequestException as ex:
+                # Client errors (e.g. invalid JQL) would fail again
+                response = getattr(ex, 'response', None)
+                client_error = response is not None \
+                    and 400 <= response.status_code < 500 \
+                    and response.status_code != 429
+                if client_error or attempt >= self.retries:
+                    raise
+
+                delay = self.retry_delay * 2 ** attempt
+                attempt += 1
+                logging.warning("Request to Jira failed (%s), retrying in "
+                                "%s seconds" % (ex, delay))
+                time.sleep(delay)
 
     def test_jira_availability(self):
         get_url = self.url
@@ -54,7 +136,7 @@ class Jira(object):
             get_url += "/"
         get_url += "issuetype"
 
-        r = requests.get(get_url, timeout=9.05)
+        r = self.session.get(get_url, timeout=9.05)
 
         if not r.ok:
             r.raise_for_status()
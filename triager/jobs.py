@@ -1,17 +1,38 @@
-import os
 import time
-import joblib
-import random
+import json
 import logging
+import resource
 import numpy as np
 
-from classifier import models, selectors, kernels, utils, tests
+from collections import deque
+
+from classifier import utils
+from classifier.document import Document
+
+import storage
+import metrics
+import evaluation
 
 from triager import db, app, config
-from models import Project, TrainStatus as TS
+from models import Project, TrainStatus as TS, TrainingJob, JobStatus
+from models import ModelType, JobKind, Feedback, TrainingRun
+from classifiers import SVMModel, LinearModel, TermCounts
+from utils import fingerprint
+
+
+#: Columns of project with results of evaluation of its model
+EVALUATION_COLUMNS = ['accuracy', 'precision', 'recall', 'accuracy_std',
+                      'precision_std', 'recall_std', 'evaluation_folds']
 
 
 def train_project(id):
+    """Trains model of the project and saves it. Durations of stages of the
+    training are recorded as a :class:`models.TrainingRun`.
+
+    :returns: ``True`` if the project was successfully trained.
+    """
+
+    run = TrainingRun(project_id=id, started=time.time())
     try:
         logging.info("Started training project %s" % id)
         project = Project.query.get(id)
@@ -19,73 +40,347 @@ def train_project(id):
         db.session.add(project)
         db.session.commit()
 
+        # Feedback confirmed from now on is not in the data of the training
+        started = run.started
+
         # Config
         config.reload()
-        ticket_limit = int(config.general__ticket_limit)
+        ticket_limit = get_ticket_limit(project)
         min_class_occur = int(config.general__min_class_occur)
-        C = float(config.svm__coefficient)
-        cache_size = int(config.svm__cache_size)
-
-        # retrieve data
-        # TODO: add to configuration
-        data = project.datasource.get_data()[-ticket_limit:]
-        data = utils.filter_docs(data, min_class_occur=min_class_occur)
-
-        # create training model
-        logging.debug("Training model for project %s" % id)
-        selector = selectors.TFIDFDecorator(selectors.StopWordsDecorator(
-            selectors.BasicSelector()))
-        kernel = kernels.GaussianKernel()
-        model = models.SVMModel(
-            feature_selector=selector, kernel=kernel,
-            C=C, cache_size=cache_size)
+
+        # retrieve data, only the last ticket_limit documents are kept
+        with metrics.timed(run, 'fetch_time'):
+            data = list(deque(project.datasource.iter_data(ticket_limit),
+                              maxlen=ticket_limit))
+        run.fetch_pages = project.datasource.fetch_pages
+
+        # skip training if the model would not change
+        model = create_model(project)
+        data_fingerprint = fingerprint(data, ticket_limit, min_class_occur,
+                                       str(model))
+        manifest = None
+        if project.model_version is not None:
+            manifest = storage.load_manifest(id, project.model_version)
+        if data_fingerprint == project.data_fingerprint \
+                and manifest is not None \
+                and manifest.get('format') == storage.MODEL_FORMAT:
+            logging.info("Data of project %s did not change since the last "
+                         "training, training skipped" % id)
+            project.train_status = TS.TRAINED
+            project.last_training = time.time()
+            run.skipped = True
+            _finish_run(run, TS.TRAINED)
+            db.session.add(project)
+            db.session.commit()
+            return True
+
+        with metrics.timed(run, 'filter_time'):
+            data = utils.filter_docs(data, min_class_occur=min_class_occur)
+        project.document_count = run.document_count = len(data)
+
+        # tokenize documents only once for both models
+        with metrics.timed(run, 'tokenize_time'):
+            term_counts = TermCounts(data)
 
         # train model
-        model.train(data)
-        logging.debug("Model for project %s successfully trained" % id)
-
-        # create testing model
-        logging.debug("Training model for project %s for testing" % id)
-        selector_test = selectors.TFIDFDecorator(selectors.StopWordsDecorator(
-            selectors.BasicSelector()))
-        kernel_test = kernels.GaussianKernel()
-        model_test = models.SVMModel(
-            feature_selector=selector_test, kernel=kernel_test,
-            C=C, cache_size=cache_size)
-
-        # split data for testing
-        random.shuffle(data)
-        n = len(data)
-        split_pct = 8/10.0
-        split_x = int(np.ceil(n*split_pct))
-        data_train = data[:split_x]
-        data_test = data[split_x:]
-
-        # train testing model
-        model_test.train(data_train)
-        logging.debug("Testing model for project %s successfully trained" % id)
-
-        # testing model
-        project.accuracy = tests.accuracy(model_test, data_test)
-        project.precision, project.recall = tests.precision_and_recall(
-            model_test, data_test)
-
-        # save
-        dump_dir = os.path.join(app.config['MODEL_FOLDER'], str(id))
-        if not os.path.exists(dump_dir):
-            os.mkdir(dump_dir)
-        joblib.dump(model, os.path.join(dump_dir, 'svm.pkl'))
+        logging.debug("Training %s for project %s" % (model, id))
+        with metrics.timed(run, 'train_time'):
+            model.train_counts(term_counts)
+        logging.debug("Model for project %s successfully trained in %.1f s"
+                      % (id, run.train_time))
+
+        # evaluate model by cross-validation
+        logging.debug("Cross-validating model for project %s" % id)
+        model_test = create_model(project)
+        with metrics.timed(run, 'evaluation_time'):
+            folds = evaluation.cross_validate(
+                model_test, term_counts, k=app.config['EVALUATION_FOLDS'],
+                seed=app.config['EVALUATION_SEED'],
+                processes=app.config['EVALUATION_PROCESSES'],
+                timeout=app.config['EVALUATION_TIMEOUT'])
+        logging.debug("Model for project %s evaluated on %s folds"
+                      % (id, len(folds)))
+
+        if folds:
+            mean = np.mean(folds, axis=0)
+            std = np.std(folds, axis=0)
+            project.accuracy, project.precision, project.recall = mean
+            project.accuracy_std, project.precision_std, \
+                project.recall_std = std
+            project.evaluation_folds = json.dumps(folds)
+        else:
+            # Evaluation of the previous model does not apply to this one
+            logging.warning("Model of project %s was not evaluated" % id)
+            for column in EVALUATION_COLUMNS:
+                setattr(project, column, 0.0)
+            project.evaluation_folds = None
+
+        # save and publish, evaluation is saved with the model so that it
+        # can be restored when the model is rolled back to
+        with metrics.timed(run, 'save_time'):
+            manifest = storage.save_model(
+                id, model, document_count=len(data),
+                fingerprint=data_fingerprint,
+                evaluation=dict((column, getattr(project, column))
+                                for column in EVALUATION_COLUMNS),
+                feedback_until=started)
+            storage.publish(id, manifest['version'])
+        project.model_version = manifest['version']
+        project.feedback_until = started
         project.train_status = TS.TRAINED
         project.last_training = time.time()
+        project.data_fingerprint = data_fingerprint
+        _finish_run(run, TS.TRAINED)
         db.session.add(project)
         db.session.commit()
-        logging.info("Project %s successfully trained and updated." % id)
+        logging.info("Project %s successfully trained and updated in %.1f s."
+                     % (id, run.total_time))
+        return True
     except Exception as ex:
         logging.error("Failed to train project %s" % id)
         logging.exception(ex)
 
+        db.session.rollback()
+        project = Project.query.get(id)
+        if project is None:
+            return False
+
         project.train_status = TS.FAILED
         project.training_message = "Reason: %s: %s" % (
             ex.__class__.__name__, ex)
+        _finish_run(run, TS.FAILED)
         db.session.add(project)
         db.session.commit()
+        return False
+
+
+def _finish_run(run, status):
+    run.status = status
+    run.total_time = time.time() - run.started
+    run.save()
+
+
+def update_project(id):
+    """Updates the published model of the project by feedback confirmed since
+    the model was trained or last updated, and publishes the updated model as
+    a new version. Only models that support updates (see
+    :meth:`classifiers.Model.update`) can be updated, other models learn from
+    the feedback when they are trained again.
+
+    :returns: ``True`` if the model was updated or there was nothing to
+              update.
+    """
+
+    try:
+        project = Project.query.get(id)
+        version = project.model_version
+        manifest = None
+        if version is not None:
+            manifest = storage.load_manifest(id, version)
+        if manifest is None or not manifest.get('updatable'):
+            logging.info("Project %s has no model to update" % id)
+            return True
+
+        feedback = Feedback.query.filter(
+            Feedback.project_id == id,
+            Feedback.confirmed > (project.feedback_until or 0),
+            Feedback.confirmed_label != None).order_by(  # noqa
+                Feedback.confirmed).all()
+        if not feedback:
+            return True
+
+        logging.info("Updating model of project %s by %s confirmed issues"
+                     % (id, len(feedback)))
+        model = storage.load_model(id, version)
+        model.update([Document(f.summary, f.description, f.confirmed_label)
+                      for f in feedback])
+
+        feedback_until = feedback[-1].confirmed
+        manifest = storage.save_model(
+            id, model, document_count=manifest.get('document_count'),
+            fingerprint=manifest.get('fingerprint'),
+            evaluation=manifest.get('evaluation', {}),
+            feedback_until=feedback_until, updated_from=version)
+
+        # The project might have been trained meanwhile, the updated model
+        # is published only if the updated version is still the current one
+        switched = Project.query.filter(
+            Project.id == id, Project.model_version == version).update(
+                {Project.model_version: manifest['version'],
+                 Project.feedback_until: feedback_until},
+                synchronize_session=False)
+        if not switched:
+            db.session.rollback()
+            storage.discard(id, manifest['version'])
+            logging.info("Model of project %s changed during the update, "
+                         "update discarded" % id)
+            return True
+
+        storage.publish(id, manifest['version'])
+        db.session.commit()
+        logging.info("Model of project %s successfully updated." % id)
+        return True
+    except Exception as ex:
+        logging.error("Failed to update model of project %s" % id)
+        logging.exception(ex)
+        db.session.rollback()
+        return False
+
+
+def create_model(project):
+    """Returns untrained model of the type of the project."""
+
+    if project.model_type == ModelType.LINEAR:
+        return LinearModel()
+
+    return SVMModel(C=float(config.svm__coefficient),
+                    cache_size=int(config.svm__cache_size))
+
+
+def get_ticket_limit(project):
+    """Returns maximum number of documents the model of the project is
+    trained on.
+    """
+
+    if project.model_type == ModelType.LINEAR:
+        return int(config.linear__ticket_limit)
+
+    return int(config.general__ticket_limit)
+
+
+def rollback_project(id):
+    """Publishes the previous version of the model of the project and
+    restores evaluation of that version.
+
+    :returns: The published version or ``None`` if there is no previous
+              version.
+    """
+
+    project = Project.query.get(id)
+    if project is None or project.model_version is None:
+        return None
+
+    version = storage.get_previous_version(id, project.model_version)
+    if version is None:
+        return None
+
+    manifest = storage.load_manifest(id, version)
+    storage.publish(id, version)
+    project.model_version = version
+    project.data_fingerprint = manifest.get('fingerprint')
+    project.document_count = manifest.get('document_count')
+    project.feedback_until = manifest.get('feedback_until')
+    for column, value in manifest.get('evaluation', {}).items():
+        setattr(project, column, value)
+    db.session.add(project)
+    db.session.commit()
+    logging.info("Model of project %s rolled back to version %s"
+                 % (id, version))
+    return version
+
+
+def estimate_memory(project):
+    """Estimates memory in bytes needed to train the project from the number
+    of its documents and the type of its model. The estimate is at most the
+    memory limit of the scheduler.
+    """
+
+    config.reload()
+    documents = project.document_count or get_ticket_limit(project)
+    per_document = app.config['SCHEDULER_MEMORY_PER_DOCUMENT']
+    model_memory = documents * per_document.get(
+        project.model_type, per_document[ModelType.SVM])
+
+    if project.model_type != ModelType.LINEAR:
+        # Precomputed kernel matrix of doubles
+        model_memory += documents ** 2 * 8
+        # SVM does not cache more than the whole kernel matrix of floats
+        model_memory += min(int(config.svm__cache_size) * 1024 * 1024,
+                            documents ** 2 * 4)
+
+    # Models of cross-validation folds are trained in parallel
+    processes = 1 + app.config['EVALUATION_PROCESSES']
+    return min(app.config['SCHEDULER_MEMORY_BASE'] + processes * model_memory,
+               app.config['SCHEDULER_MEMORY_LIMIT'])
+
+
+def run_job(job_id):
+    """Trains or updates the project of a claimed job and records the result
+    together with the peak memory and CPU time of the job. Peak memory is
+    the peak of the summed memory of the process and its evaluation
+    processes (see :class:`metrics.MemorySampler`). The job should be run in
+    its own process, otherwise the memory of the whole process is included.
+    """
+
+    job = TrainingJob.query.get(job_id)
+    if job.project is None:
+        job.attempts = app.config['SCHEDULER_MAX_ATTEMPTS']
+        finish_job(job, False, "Project no longer exists")
+        return
+
+    # Evaluation processes train at the same time, so memory of the whole
+    # process tree is measured
+    with metrics.MemorySampler() as memory:
+        if job.kind == JobKind.UPDATE:
+            success = update_project(job.project_id)
+        else:
+            success = train_project(job.project_id)
+
+    peak_memory = memory.peak
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    children_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    cpu_time = usage.ru_utime + usage.ru_stime \
+        + children_usage.ru_utime + children_usage.ru_stime
+
+    job = TrainingJob.query.get(job_id)
+    if job is None or job.project is None:
+        # Project was deleted during training
+        return
+
+    logging.info("%s of project %s took %.1f s of CPU time, peak memory "
+                 "%.1f MB" % (job.kind.capitalize(), job.project_id, cpu_time,
+                              peak_memory / 1024.0 / 1024.0))
+    job.peak_memory = peak_memory
+    job.cpu_time = cpu_time
+    if job.kind == JobKind.UPDATE:
+        finish_job(job, success, None if success else "Update failed")
+        return
+
+    # Memory estimates of the project are based on full trainings only
+    job.project.peak_memory = peak_memory
+    job.project.cpu_time = cpu_time
+    finish_job(job, success,
+               None if success else job.project.training_message)
+
+
+def finish_job(job, success, message=None):
+    """Records result of the job. Failed training jobs are queued again with
+    exponentially growing delay until they run out of attempts. Failed update
+    jobs are not retried, the next update or training catches up.
+    """
+
+    job.finished = time.time()
+    job.message = message
+    if success:
+        job.status = JobStatus.DONE
+    elif job.kind == JobKind.UPDATE:
+        logging.warning("Update of project %s failed" % job.project_id)
+        job.status = JobStatus.FAILED
+    elif job.attempts < app.config['SCHEDULER_MAX_ATTEMPTS']:
+        delay = app.config['SCHEDULER_RETRY_DELAY'] * 2 ** (job.attempts - 1)
+        logging.warning("Training of project %s failed, retrying in %s "
+                        "seconds" % (job.project_id, delay))
+        job.status = JobStatus.QUEUED
+        job.not_before = job.finished + delay
+        job.worker_pid = None
+        job.worker_token = None
+        if job.project:
+            job.project.train_status = TS.QUEUED
+    else:
+        job.status = JobStatus.FAILED
+        if job.project and job.project.train_status != TS.FAILED:
+            job.project.train_status = TS.FAILED
+            job.project.training_message = message
+
+    db.session.add(job)
+    db.session.commit()
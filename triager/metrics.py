@@ -0,0 +1,168 @@
+import os
+import time
+import resource
+import threading
+
+from contextlib import contextmanager
+
+from utils import get_tree_memory
+
+
+#: Upper bounds in seconds of buckets of duration histograms
+DURATION_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+                    2.5, 5.0, 10.0, 30.0, 60.0, 300.0, 900.0, 3600.0)
+
+
+class Histogram(object):
+    """Histogram of observed values, labeled by values of given label names.
+    Buckets are cumulative and can be exposed in the Prometheus text format.
+    Observations are safe to make from multiple threads.
+    """
+
+    def __init__(self, name, documentation, labels=(),
+                 buckets=DURATION_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.buckets = tuple(sorted(buckets))
+
+        # Label values -> [count of each bucket..., sum, count]
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        if len(label_values) != len(self.labels):
+            raise ValueError("Expected values of labels %s"
+                             % ", ".join(self.labels))
+
+        label_values = tuple(str(v) for v in label_values)
+        with self.lock:
+            counts = self.values.get(label_values)
+            if counts is None:
+                counts = self.values[label_values] = \
+                    [0] * (len(self.buckets) + 2)
+
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            counts[-2] += value
+            counts[-1] += 1
+
+    def get_counts(self, *label_values):
+        """Returns copy of counts of the buckets followed by the sum and the
+        count of values observed with given label values, or ``None`` if
+        there are no such values.
+        """
+
+        with self.lock:
+            counts = self.values.get(tuple(str(v) for v in label_values))
+            return list(counts) if counts is not None else None
+
+    def set_counts(self, counts, *label_values):
+        """Replaces values observed with given label values by counts
+        returned by :meth:`get_counts` of a histogram with the same buckets.
+        """
+
+        if len(counts) != len(self.buckets) + 2:
+            raise ValueError("Expected counts of %s buckets"
+                             % len(self.buckets))
+
+        with self.lock:
+            self.values[tuple(str(v) for v in label_values)] = list(counts)
+
+    @contextmanager
+    def time(self, *label_values):
+        """Observes duration of the ``with`` block in seconds."""
+
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(time.time() - start, *label_values)
+
+    def expose(self):
+        """Returns the histogram in the Prometheus text format."""
+
+        lines = ["# HELP %s %s" % (self.name, self.documentation),
+                 "# TYPE %s histogram" % self.name]
+
+        with self.lock:
+            values = sorted((k, list(v)) for k, v in self.values.items())
+
+        for label_values, counts in values:
+            labels = zip(self.labels, label_values)
+            for bound, count in zip(self.buckets, counts):
+                lines.append(self._sample(
+                    "_bucket", labels + [("le", repr(float(bound)))], count))
+            lines.append(self._sample(
+                "_bucket", labels + [("le", "+Inf")], counts[-1]))
+            lines.append(self._sample("_sum", labels, counts[-2]))
+            lines.append(self._sample("_count", labels, counts[-1]))
+
+        return "\n".join(lines) + "\n"
+
+    def _sample(self, suffix, labels, value):
+        if labels:
+            labels = "{%s}" % ",".join('%s="%s"' % (name, _escape(value))
+                                       for name, value in labels)
+        else:
+            labels = ""
+        return "%s%s%s %r" % (self.name, suffix, labels, float(value))
+
+
+def _escape(value):
+    return value.replace("\\", "\\\\").replace("\n", "\\n") \
+        .replace('"', '\\"')
+
+
+@contextmanager
+def timed(obj, attribute):
+    """Sets the attribute of the object to duration of the ``with`` block in
+    seconds. The duration is set even if the block raises an exception.
+    """
+
+    start = time.time()
+    try:
+        yield
+    finally:
+        setattr(obj, attribute, time.time() - start)
+
+
+
+class MemorySampler(object):
+    """Measures peak memory in bytes used by a ``with`` block, i.e. the peak
+    of the summed resident memory of this process and its children (e.g. a
+    pool of processes) sampled every ``interval`` seconds. Peak memory of
+    the largest single process is used instead if it is higher, e.g. when
+    ``/proc`` is not available or a short peak falls between the samples.
+    Memory used by the process before the block is included, so the block
+    should be run in a new process.
+    """
+
+    def __init__(self, interval=1.0):
+        self.interval = interval
+        self.peak = 0
+        self._done = threading.Event()
+        self._thread = None
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self._sample,
+                                        name="MemorySampler")
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._done.set()
+        self._thread.join()
+        # Children are already terminated and waited for
+        largest = max(
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) * 1024
+        self.peak = max(self.peak, largest)
+
+    def _sample(self):
+        while True:
+            self.peak = max(self.peak, get_tree_memory(os.getpid()) or 0)
+            if self._done.wait(self.interval):
+                return
@@ -1,10 +1,17 @@
 import re
+import json
+import time
 import hashlib
+import logging
 
+from sqlalchemy import inspect, literal
+from sqlalchemy.orm import aliased
 from classifier.document import Document
 
-from triager import db, config
+from triager import db, app, config
 from jira import Jira
+from metrics import Histogram, DURATION_BUCKETS
+from utils import get_process_token
 
 
 class TrainStatus(object):
@@ -20,6 +27,29 @@ class TrainStatus(object):
         return status in active_statuses
 
 
+class ModelType(object):
+    SVM = "svm"
+    LINEAR = "linear"
+
+
+class JobKind(object):
+    #: Full training of the model from the data source
+    TRAIN = "train"
+    #: Update of the model by confirmed feedback
+    UPDATE = "update"
+
+
+class JobStatus(object):
+    QUEUED = "queued"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+
+    @classmethod
+    def is_active(cls, status):
+        return status in [cls.QUEUED, cls.RUNNING]
+
+
 class Project(db.Model):
     id = db.Column(db.Integer, primary_key=True)
 
@@ -33,15 +63,283 @@ class Project(db.Model):
         db.String(10), default=TrainStatus.NOT_TRAINED, nullable=False)
     training_message = db.Column(db.String(253))
     schedule = db.Column(db.String(63), default="0 0 * * *")
+    model_type = db.Column(
+        db.String(10), default=ModelType.SVM, nullable=False)
     last_training = db.Column(db.Float(), default=0.0)
 
+    #: Fingerprint of data and configuration the current model was trained on
+    data_fingerprint = db.Column(db.String(40))
+
+    #: Version of the published model, see :mod:`storage`
+    model_version = db.Column(db.BigInteger)
+
+    #: Confirmed feedback up to this time is already reflected in the
+    #: published model
+    feedback_until = db.Column(db.Float())
+
+    #: Mean and standard deviation of cross-validation results
     accuracy = db.Column(db.Float(), default=0.0)
     precision = db.Column(db.Float(), default=0.0)
     recall = db.Column(db.Float(), default=0.0)
+    accuracy_std = db.Column(db.Float(), default=0.0)
+    precision_std = db.Column(db.Float(), default=0.0)
+    recall_std = db.Column(db.Float(), default=0.0)
+
+    #: JSON list of accuracy, precision and recall of each evaluated fold
+    evaluation_folds = db.Column(db.Text)
+
+    #: Number of documents, peak memory in bytes and CPU time in seconds of
+    #: the last training
+    document_count = db.Column(db.Integer)
+    peak_memory = db.Column(db.Integer)
+    cpu_time = db.Column(db.Float())
 
     __table_args__ = {'sqlite_autoincrement': True}
 
 
+class TrainingJob(db.Model):
+    """Training of a project queued by the scheduler and claimed by one of
+    its workers.
+    """
+
+    __tablename__ = "training_job"
+    id = db.Column(db.Integer, primary_key=True)
+
+    project_id = db.Column(db.Integer, db.ForeignKey('project.id'),
+                           index=True)
+    project = db.relationship("Project")
+
+    kind = db.Column(db.String(10), default=JobKind.TRAIN, nullable=False)
+    status = db.Column(db.String(10), default=JobStatus.QUEUED,
+                       nullable=False, index=True)
+    attempts = db.Column(db.Integer, default=0, nullable=False)
+    message = db.Column(db.String(253))
+
+    #: The job cannot be claimed before this time
+    not_before = db.Column(db.Float(), default=0.0, nullable=False)
+    created = db.Column(db.Float(), default=time.time)
+    started = db.Column(db.Float())
+    finished = db.Column(db.Float())
+
+    #: Pid of the worker that claimed the job and its token (see
+    #: :func:`utils.get_process_token`)
+    worker_pid = db.Column(db.Integer)
+    worker_token = db.Column(db.String(127))
+
+    #: Estimated and measured peak memory in bytes and CPU time in seconds
+    memory_estimate = db.Column(db.Integer, default=0, nullable=False)
+    peak_memory = db.Column(db.Integer)
+    cpu_time = db.Column(db.Float())
+
+    __table_args__ = {'sqlite_autoincrement': True}
+
+    @classmethod
+    def enqueue(cls, project_id, memory_estimate=0, kind=JobKind.TRAIN):
+        """Creates new job of given kind for the project unless the project
+        already has a queued or running job of the same kind.
+
+        :returns: The new job or ``None`` if the project already has one.
+        """
+
+        active_job = cls.query.filter(
+            cls.project_id == project_id, cls.kind == kind,
+            cls.status.in_([JobStatus.QUEUED, JobStatus.RUNNING])).first()
+        if active_job:
+            return None
+
+        job = cls(project_id=project_id, memory_estimate=memory_estimate,
+                  kind=kind)
+        db.session.add(job)
+        return job
+
+    @classmethod
+    def claim(cls, worker_pid, memory_limit=None):
+        """Atomically claims the oldest queued job that can be started. If
+        memory limit is given, only a job whose estimated memory fits the
+        limit together with the already running jobs is claimed. A job is
+        always claimed when no other job is running.
+
+        :returns: The claimed job or ``None`` if there is no such job.
+        """
+
+        now = time.time()
+        worker_token = get_process_token(worker_pid)
+        candidates = db.session.query(cls.id, cls.memory_estimate) \
+            .filter(cls.status == JobStatus.QUEUED, cls.not_before <= now) \
+            .order_by(cls.not_before, cls.id)
+
+        running_jobs = aliased(cls)
+        running_memory = db.select([
+            db.func.coalesce(db.func.sum(running_jobs.memory_estimate), 0)
+        ]).where(running_jobs.status == JobStatus.RUNNING).as_scalar()
+        running_count = db.select([db.func.count(running_jobs.id)]) \
+            .where(running_jobs.status == JobStatus.RUNNING).as_scalar()
+
+        for job_id, memory_estimate in candidates.all():
+            query = cls.query.filter(
+                cls.id == job_id, cls.status == JobStatus.QUEUED)
+            if memory_limit is not None:
+                query = query.filter(db.or_(
+                    running_count == 0,
+                    running_memory + memory_estimate <= memory_limit))
+
+            claimed = query.update({cls.status: JobStatus.RUNNING,
+                                    cls.attempts: cls.attempts + 1,
+                                    cls.worker_pid: worker_pid,
+                                    cls.worker_token: worker_token,
+                                    cls.started: now},
+                                   synchronize_session=False)
+            db.session.commit()
+            if claimed:
+                return cls.query.get(job_id)
+
+        return None
+
+    @classmethod
+    def recover(cls):
+        """Requeues running jobs whose workers are no longer alive. A worker
+        is alive only if the process with its pid is the same process that
+        claimed the job, pids are reused by other processes.
+        """
+
+        for job in cls.query.filter_by(status=JobStatus.RUNNING):
+            if job.worker_token is not None and job.worker_pid is not None \
+                    and get_process_token(job.worker_pid) == job.worker_token:
+                continue
+
+            logging.warning("Job %s of project %s was interrupted, "
+                            "requeuing" % (job.id, job.project_id))
+            job.status = JobStatus.QUEUED
+            job.worker_pid = None
+            job.worker_token = None
+            db.session.add(job)
+
+        db.session.commit()
+
+
+class TrainingRun(db.Model):
+    """Durations in seconds of stages of a single training of a project.
+    Stages that did not run have no duration.
+    """
+
+    __tablename__ = "training_run"
+
+    #: Stages of the training in the order they run
+    STAGES = ['fetch', 'filter', 'tokenize', 'train', 'evaluation', 'save',
+              'total']
+
+    #: Upper bounds of buckets of the histogram of fetched pages
+    PAGE_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+    id = db.Column(db.Integer, primary_key=True)
+
+    project_id = db.Column(db.Integer, db.ForeignKey('project.id'),
+                           index=True)
+    started = db.Column(db.Float(), default=time.time)
+    #: Trained or failed, see :class:`TrainStatus`
+    status = db.Column(db.String(10))
+    #: The model was not trained, because its data did not change
+    skipped = db.Column(db.Boolean(), default=False, nullable=False)
+    document_count = db.Column(db.Integer)
+
+    #: Number of pages downloaded by the data source, if it downloads any
+    fetch_pages = db.Column(db.Integer)
+
+    fetch_time = db.Column(db.Float())
+    filter_time = db.Column(db.Float())
+    tokenize_time = db.Column(db.Float())
+    train_time = db.Column(db.Float())
+    evaluation_time = db.Column(db.Float())
+    save_time = db.Column(db.Float())
+    total_time = db.Column(db.Float())
+
+    __table_args__ = {'sqlite_autoincrement': True}
+
+    def save(self):
+        """Adds the finished run to the session together with its durations
+        to the histograms of the project (see :class:`TrainingMetric`). Only
+        the last ``TRAINING_RUNS_KEPT`` runs of the project are kept.
+        """
+
+        db.session.add(self)
+        for stage in self.STAGES:
+            duration = getattr(self, stage + "_time")
+            if duration is not None:
+                TrainingMetric.observe(self.project_id, "stage_seconds",
+                                       stage, duration)
+        if self.fetch_pages is not None:
+            TrainingMetric.observe(self.project_id, "fetch_pages", "",
+                                   self.fetch_pages, self.PAGE_BUCKETS)
+
+        db.session.flush()
+        old_runs = db.session.query(TrainingRun.id) \
+            .filter_by(project_id=self.project_id) \
+            .order_by(TrainingRun.id.desc()) \
+            .offset(app.config['TRAINING_RUNS_KEPT']).all()
+        if old_runs:
+            TrainingRun.query.filter(
+                TrainingRun.project_id == self.project_id,
+                TrainingRun.id <= old_runs[0].id).delete(
+                    synchronize_session=False)
+
+    @classmethod
+    def histograms(cls):
+        """Returns histograms of durations of the stages and of fetched pages
+        of all the recorded runs by project.
+        """
+
+        stages = Histogram(
+            "triager_training_stage_seconds",
+            "Duration of stages of training of projects.",
+            labels=("project", "stage"))
+        pages = Histogram(
+            "triager_fetch_pages",
+            "Number of pages downloaded by data sources of projects.",
+            labels=("project",), buckets=cls.PAGE_BUCKETS)
+
+        for metric in TrainingMetric.query:
+            counts = json.loads(metric.counts)
+            if metric.name == "stage_seconds":
+                stages.set_counts(counts, metric.project_id, metric.label)
+            elif metric.name == "fetch_pages":
+                pages.set_counts(counts, metric.project_id)
+
+        return [stages, pages]
+
+
+class TrainingMetric(db.Model):
+    """Histogram of values of a metric of trainings of a project, kept as
+    running counts, so that histograms of all the trainings are not
+    computed from the individual runs.
+    """
+
+    __tablename__ = "training_metric"
+
+    project_id = db.Column(db.Integer, db.ForeignKey('project.id'),
+                           primary_key=True)
+    name = db.Column(db.String(63), primary_key=True)
+    label = db.Column(db.String(63), primary_key=True)
+    #: JSON list of counts of the buckets, sum and count of the values, see
+    #: :meth:`metrics.Histogram.get_counts`
+    counts = db.Column(db.Text, nullable=False)
+
+    @classmethod
+    def observe(cls, project_id, name, label, value,
+                buckets=DURATION_BUCKETS):
+        """Adds the value to the histogram of the metric of the project."""
+
+        metric = cls.query.get((project_id, name, label))
+        if metric is None:
+            metric = cls(project_id=project_id, name=name, label=label)
+
+        histogram = Histogram(name, name, buckets=buckets)
+        if metric.counts:
+            histogram.set_counts(json.loads(metric.counts))
+        histogram.observe(value)
+        metric.counts = json.dumps(histogram.get_counts())
+        db.session.add(metric)
+
+
 class Feedback(db.Model):
     id = db.Column(db.String(128), primary_key=True)
 
@@ -50,6 +348,15 @@ class Feedback(db.Model):
 
     selected_recommendation = db.Column(db.Integer, default=0)
     confirmed_recommendation = db.Column(db.Integer, default=0)
+    created = db.Column(db.Float(), default=time.time, index=True)
+
+    #: Text of the issue and the assignee of the confirmed recommendation,
+    #: used to update the model
+    summary = db.Column(db.Text)
+    description = db.Column(db.Text)
+    confirmed_label = db.Column(db.String(255))
+    #: Time the recommendation was confirmed
+    confirmed = db.Column(db.Float(), index=True)
 
     @classmethod
     def get_id_from_doc(cls, document, project=None):
@@ -72,36 +379,191 @@ class DataSource(db.Model):
         'polymorphic_on': type
     }
 
-    def get_data(self):
+    #: Number of pages downloaded by the last :meth:`iter_data`, ``None`` if
+    #: the data source does not download any pages
+    fetch_pages = None
+
+    def get_data(self, limit=None):
+        return list(self.iter_data(limit))
+
+    def iter_data(self, limit=None):
+        """Yields documents used for training one by one. Only the last
+        ``limit`` documents are used, but more of them may be yielded.
+        """
         raise NotImplementedError()
 
+    def clear_data(self):
+        """Removes any data stored locally by the data source."""
+        pass
+
+
+class JiraIssue(db.Model):
+    """Local copy of a Jira issue used for training."""
+
+    __tablename__ = "jira_issue"
+    datasource_id = db.Column(
+        db.Integer, db.ForeignKey('datasource.id'), primary_key=True)
+    key = db.Column(db.String(63), primary_key=True)
+
+    summary = db.Column(db.Text)
+    description = db.Column(db.Text)
+    assignee = db.Column(db.String(253))
+    created = db.Column(db.String(63))
+
 
 class JiraDataSource(DataSource):
+    #: Number of minutes by which the synchronizations overlap so that no
+    #: issue is missed due to clock differences between Triager and Jira.
+    SYNC_OVERLAP = 5
+
+    #: Number of issues stored or loaded from the issue store at once.
+    SYNC_BATCH_SIZE = 500
+
     jira_api_url = db.Column(db.String(253))
     jira_project_key = db.Column(db.String(63))
     jira_statuses = db.Column(db.String(63), default="Resolved,Closed")
     jira_resolutions = db.Column(db.String(63))
+    last_sync = db.Column(db.Float(), default=0.0)
+    last_full_sync = db.Column(db.Float(), default=0.0)
+    #: Maximum number of issues downloaded by the last full synchronization
+    sync_limit = db.Column(db.Integer)
 
     __mapper_args__ = {
         'polymorphic_identity': 'jira'
     }
 
-    def get_data(self):
-        jira = Jira(self.jira_api_url)
-        jql = "project=%s and status in (%s) " + \
-              "and assignee!=null"
+    def iter_data(self, limit=None):
+        self.sync(limit or int(config.general__ticket_limit))
+
+        issues = db.session.query(
+            JiraIssue.summary, JiraIssue.description, JiraIssue.assignee) \
+            .filter_by(datasource_id=self.id) \
+            .order_by(JiraIssue.created) \
+            .yield_per(self.SYNC_BATCH_SIZE)
+        for summary, description, assignee in issues:
+            yield Document(summary, description, assignee)
+
+    def sync(self, limit):
+        """Downloads issues that were updated since the last synchronization
+        and stores them in the local issue store. All issues, at most
+        ``limit`` of the newest ones, are downloaded if the data source has
+        not been fully synchronized for ``JIRA_FULL_SYNC_INTERVAL`` or with
+        a lower limit, stored issues that were not downloaded then are
+        removed.
+        """
+
+        jira = Jira(self.jira_api_url,
+                    concurrency=app.config['JIRA_CONCURRENCY'],
+                    retries=app.config['JIRA_RETRIES'])
+        sync_started = time.time()
+        full_sync = sync_started - (self.last_full_sync or 0.0) \
+            >= app.config['JIRA_FULL_SYNC_INTERVAL'] \
+            or limit > (self.sync_limit or 0)
+
+        jql = "project=%s and status in (%s) and assignee!=null"
         jql = jql % (self.jira_project_key, self.jira_statuses)
         if self.jira_resolutions:
-            jql += " resolutions in (%s)" % self.jira_resolutions
+            jql += " and resolution in (%s)" % self.jira_resolutions
+        if self.last_sync and not full_sync:
+            # Relative date is used so that the timezone of Jira is irrelevant
+            minutes = int((sync_started - self.last_sync) / 60)
+            jql += " and updated >= -%sm" % (minutes + self.SYNC_OVERLAP)
+        jql += " order by created desc"
+
         fields = 'summary,description,assignee,created'
-        raw_issues = jira.find_all(jql, fields,
-                                   limit=int(config.general__ticket_limit))
+        raw_issues = jira.iter_all(jql, fields, limit=limit)
+
+        # Issues are stored as they are downloaded, so that the raw JSON of
+        # all the issues is never held in memory at once
+        datasource_id = self.id
+        count = 0
+        keys = set()
+        for raw_issue in raw_issues:
+            fields = raw_issue['fields']
+            issue = JiraIssue(datasource_id=datasource_id,
+                              key=raw_issue['key'])
+            issue.summary = fields['summary']
+            issue.description = fields['description']
+            issue.assignee = fields['assignee']['name']
+            issue.created = fields['created']
+            db.session.merge(issue)
+            if full_sync:
+                keys.add(issue.key)
+
+            count += 1
+            if count % self.SYNC_BATCH_SIZE == 0:
+                db.session.commit()
+        logging.debug("Downloaded %s updated issues of data source %s"
+                      % (count, datasource_id))
+
+        if full_sync:
+            self._remove_issues_except(keys)
+            self.last_full_sync = sync_started
+            self.sync_limit = limit
+
+        self.fetch_pages = jira.page_count
+        self.last_sync = sync_started
+        db.session.add(self)
+        db.session.commit()
+
+    def _remove_issues_except(self, keys):
+        """Removes stored issues whose keys are not in given set."""
+
+        db.session.commit()
+        stored_keys = db.session.query(JiraIssue.key) \
+            .filter_by(datasource_id=self.id).all()
+        removed = [key for key, in stored_keys if key not in keys]
+        for i in range(0, len(removed), self.SYNC_BATCH_SIZE):
+            JiraIssue.query.filter(
+                JiraIssue.datasource_id == self.id,
+                JiraIssue.key.in_(removed[i:i + self.SYNC_BATCH_SIZE])) \
+                .delete(synchronize_session=False)
+        db.session.commit()
+        logging.debug("Removed %s issues of data source %s that no longer "
+                      "match its query" % (len(removed), self.id))
+
+    def clear_data(self):
+        JiraIssue.query.filter_by(datasource_id=self.id).delete()
+        self.last_sync = 0.0
+        self.last_full_sync = 0.0
+        self.sync_limit = None
+
+
+def upgrade_schema():
+    """Adds tables, columns and indexes missing in a database created by an
+    older version. Columns are added with their default values if they have
+    constant ones, otherwise they are empty.
+
+    :returns: List of added columns as *table.column* strings.
+    """
+
+    db.create_all()
+    inspector = inspect(db.engine)
+    added = []
+    for table in db.metadata.sorted_tables:
+        columns = set(column['name']
+                      for column in inspector.get_columns(table.name))
+        for column in table.columns:
+            if column.name in columns:
+                continue
+
+            ddl = "ALTER TABLE %s ADD COLUMN %s %s" % (
+                table.name, column.name,
+                column.type.compile(dialect=db.engine.dialect))
+            if column.default is not None and column.default.is_scalar:
+                default = literal(column.default.arg, column.type).compile(
+                    dialect=db.engine.dialect,
+                    compile_kwargs={'literal_binds': True})
+                ddl += " DEFAULT %s" % default
+                if not column.nullable:
+                    ddl += " NOT NULL"
+            db.engine.execute(ddl)
+            added.append("%s.%s" % (table.name, column.name))
 
-        data = []
-        for issue in raw_issues:
-            fields = issue['fields']
-            document = Document(fields['summary'], fields['description'],
-                                fields['assignee']['name'])
-            data.append(document)
+        indexes = set(index['name']
+                      for index in inspector.get_indexes(table.name))
+        for index in table.indexes:
+            if index.name not in indexes:
+                index.create(db.engine)
 
-        return data
+    return added
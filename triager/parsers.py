@@ -3,117 +3,385 @@ import re
 import csv
 import logging
 import json
-import simplejson
+import cPickle
+import itertools
+import multiprocessing
 import numpy as np
 
 from classifier.document import Document
 from classifier.parsers import DocumentParser, Label
 
 
-class MRSParser(DocumentParser):
-    """Parses MRS data stored in a folder as html files into list of documents.
-    Title of the document is parsed from the header of the file, content is
-    parsed from *Problem Description* section. Label is parsed from the first
-    *Action-By* field which represents the assignee. If Action-By field
-    contains *Unassigned*, the label is replaced by ``None`` object in the
-    ``Document`` object.
+class ParseCache(object):
+    """Cache of records parsed from files of a data folder. The cache is
+    stored in file *<folder>.parsecache* next to the folder. Every record is
+    stored under a key together with signature (size and modification time)
+    of the files it was parsed from, so it is used only if none of the files
+    changed since. Records that are not used by a parser are dropped when the
+    cache is saved. The whole cache is loaded into memory and records are
+    stored in it as lists.
     """
 
-    def __init__(self, folder, project_match=".*"):
-        self.folder = folder
-        self.project_match = project_match
+    def __init__(self, folder):
+        self.path = os.path.abspath(folder).rstrip(os.sep) + ".parsecache"
+        self.entries = {}
+        self.used_entries = {}
+
+        try:
+            with open(self.path, 'rb') as f:
+                self.entries = cPickle.load(f)
+        except IOError:
+            pass
+        except Exception as ex:
+            logging.warn("Could not load parse cache %s: %s", self.path, ex)
+
+    @staticmethod
+    def signature(*paths):
+        stats = [os.stat(path) for path in paths]
+        return tuple((stat.st_size, stat.st_mtime) for stat in stats)
+
+    def get(self, key, signature):
+        """Returns records stored under the key if they were parsed from
+        files with given signature, ``None`` otherwise.
+        """
 
-    def parse(self):
-        """Parses data from given folder into list of documents.
+        entry = self.entries.get(key)
+        if entry is None or entry[0] != signature:
+            return None
 
-        :returns: List of Document objects
+        self.used_entries[key] = entry
+        return entry[1]
+
+    def put(self, key, signature, records):
+        """Stores records parsed from files with given signature, the
+        signature must be taken before the files are parsed.
         """
 
-        files = os.listdir(self.folder)
-        documents = []
-
-        for f in files:
-            if f not in ['.DS_Store']:  # excluded files
-                full_f = os.path.join(self.folder, f)
-                ticket_info = self._parse_file(full_f)
-                if ticket_info and re.match(
-                        self.project_match, ticket_info[3]):
-                    if ticket_info[2] == "Unassigned":
-                        ticket_info[2] = None
-                    document = Document(
-                        ticket_info[0], ticket_info[1], ticket_info[2])
-                    document._created = ticket_info[4]
-                    documents.append(document)
+        self.used_entries[key] = (signature, records)
 
-        return documents
+    def save(self):
+        tmp_path = self.path + ".tmp"
+        try:
+            with open(tmp_path, 'wb') as f:
+                cPickle.dump(self.used_entries, f, cPickle.HIGHEST_PROTOCOL)
+            os.rename(tmp_path, self.path)
+        except (IOError, OSError) as ex:
+            logging.warn("Could not save parse cache %s: %s", self.path, ex)
 
-    def _parse_file(self, fname):
-        with open(fname) as f:
-            content = f.readlines()
-            content = [line.rstrip() for line in content]
 
-        ticket_info = [None, "", None, "", None]
-        ticket_id = os.path.basename(fname).replace(".html", "")
-        description_stage = 0
-        is_bug = False
-        for line in content:
-            if not line.startswith("|"):
+class JSONStreamReader(object):
+    """Incremental reader of a JSON file. Values are decoded one by one as
+    they are read, so only the values that are being read are held in
+    memory. Objects and arrays can be either read as a whole by
+    :meth:`read_value` or member by member by :meth:`iter_object` and
+    :meth:`iter_array`.
+    """
+
+    CHUNK_SIZE = 64*1024
+
+    def __init__(self, f):
+        self.f = f
+        self.buf = ""
+        self.pos = 0
+        # Offset of the beginning of the buffer in the file
+        self.offset = f.tell()
+        self.decoder = json.JSONDecoder()
+
+    def tell(self):
+        """Returns offset in the file of the next value to be read."""
+
+        return self.offset + self.pos
+
+    def read_value(self):
+        """Reads and returns the next value."""
+
+        self._skip_whitespace()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buf, self.pos)
+            except ValueError:
+                # Value does not fit in the buffer
+                if not self._fill():
+                    raise
                 continue
 
-            # get summary
-            summary_match = re.match("^\| " + ticket_id + " : (.*)\|$", line)
-            if summary_match and not ticket_info[0]:
-                ticket_info[0] = summary_match.group(1).strip()
+            # Number at the end of the buffer might continue in the file
+            if end < len(self.buf) or not self._fill():
+                self.pos = end
+                return value
 
-            # get project
-            project_match = re.match("^\| Found In:   ([\w]+)", line)
-            if project_match and not ticket_info[3]:
-                ticket_info[3] = project_match.group(1).strip()
+    def iter_array(self):
+        """Yields values of the next array one by one."""
 
-            # test if is bug
-            if not is_bug and re.match("\| Created:", line) \
-                    and re.match(".*\| Class: ER\|.*", line):
-                is_bug = True
+        self._expect("[")
+        if self._peek() == "]":
+            self.pos += 1
+            return
 
-            # get assignee (only from the first APS line)
-            assignee_match = re.match("\| Action-By:  ([\w,']+)", line)
-            if assignee_match and not ticket_info[2]:
-                ticket_info[2] = assignee_match.group(1).strip()
+        while True:
+            yield self.read_value()
+            if self._expect(",]") == "]":
+                return
 
-            # get date of creation
-            created_match = re.match("^\| Created:    (\d+\.\d+\.\d+)", line)
-            if created_match and not ticket_info[4]:
-                ticket_info[4] = created_match.group(1).strip()
+    def iter_object(self):
+        """Yields keys of the next object one by one, value of every yielded
+        key must be read (e.g. by :meth:`read_value`) before the next key is
+        yielded.
+        """
 
-            # get description
-            description_match = re.match(
-                "\| MR: " + ticket_id + "  Problem Description", line)
-            if description_match:
-                description_stage = 1
+        self._expect("{")
+        if self._peek() == "}":
+            self.pos += 1
+            return
+
+        while True:
+            key = self.read_value()
+            self._expect(":")
+            yield key
+            if self._expect(",}") == "}":
+                return
+
+    def _peek(self):
+        self._skip_whitespace()
+        return self.buf[self.pos]
+
+    def _expect(self, chars):
+        char = self._peek()
+        if char not in chars:
+            raise ValueError("Expected one of '%s' at offset %s, found '%s'"
+                             % (chars, self.tell(), char))
+        self.pos += 1
+        return char
+
+    def _skip_whitespace(self):
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in " \t\n\r":
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return
+            if not self._fill():
+                raise ValueError("Unexpected end of JSON file")
+
+    def _fill(self):
+        """Drops the read part of the buffer and reads more of the file into
+        it. Read size grows with the buffer, so that long values are decoded
+        only a few times.
+
+        :returns: ``False`` if the end of the file was reached.
+        """
+
+        data = self.f.read(max(self.CHUNK_SIZE, len(self.buf)))
+        if not data:
+            return False
+
+        self.offset += self.pos
+        self.buf = self.buf[self.pos:] + data
+        self.pos = 0
+        return True
+
+
+class JSONObjectIndex(object):
+    """Index of members of a JSON object stored in a file. Only the keys and
+    offsets of the values in the file are kept in memory, values are decoded
+    from the file when they are looked up.
+    """
+
+    def __init__(self, f):
+        self.f = f
+
+        keys = []
+        offsets = []
+        reader = JSONStreamReader(f)
+        for key in reader.iter_object():
+            start = reader.tell()
+            reader.read_value()
+            keys.append(key)
+            offsets.append((start, reader.tell() - start))
+
+        keys = np.array(keys, dtype=np.unicode_)
+        order = np.argsort(keys)
+        self.keys = keys[order]
+        self.offsets = np.array(offsets, dtype=np.int64).reshape(-1, 2)[order]
+
+    def __getitem__(self, key):
+        i = np.searchsorted(self.keys, key)
+        if i == len(self.keys) or self.keys[i] != key:
+            raise KeyError(key)
+
+        start, length = self.offsets[i]
+        self.f.seek(start)
+        return json.loads(self.f.read(length))
+
+
+def create_documents(records):
+    """Yields documents created from records of title, content, label and
+    optionally date of creation.
+    """
+
+    for record in records:
+        document = Document(*record[:3])
+        if len(record) > 3:
+            document._created = record[3]
+        yield document
+
+
+MRS_PROJECT = re.compile(r"^\| Found In:   ([\w]+)")
+MRS_ASSIGNEE = re.compile(r"\| Action-By:  ([\w,']+)")
+MRS_CREATED = re.compile(r"^\| Created:    (\d+\.\d+\.\d+)")
+
+
+def parse_mrs_file(fname):
+    """Parses MRS ticket stored in the html file.
+
+    :returns: List of summary, description, assignee, project and date of
+              creation of the ticket, or ``None`` if the ticket is not a bug.
+    """
+
+    ticket_info = [None, "", None, "", None]
+    ticket_id = os.path.basename(fname).replace(".html", "")
+    summary_re = re.compile(r"^\| " + re.escape(ticket_id) + r" : (.*)\|$")
+    description_start = "| MR: " + ticket_id + "  Problem Description"
+    description_stage = 0
+    is_bug = False
+
+    # Lines after the description are never read
+    with open(fname) as f:
+        for line in f:
+            if not line.startswith("|"):
                 continue
+            line = line.rstrip()
+
             if description_stage == 1:
                 if line.startswith("|*** "):
                     description_stage = 2
             elif description_stage == 2:
                 if line.startswith("|*** ") or line.startswith("|---"):
-                    description_stage = 3
                     break
                 ticket_info[1] += line.replace("|", "").strip() + "\n"
 
-        if not is_bug:
-            return None
+            # get summary
+            if not ticket_info[0]:
+                summary_match = summary_re.match(line)
+                if summary_match:
+                    ticket_info[0] = summary_match.group(1).strip()
 
-        if not ticket_info[0]:
-            logging.warn("Could not parse summary from ticket %s.", ticket_id)
-        if not ticket_info[1]:
-            logging.warn(
-                "Could not parse description from ticket %s", ticket_id)
+            # get project
+            if not ticket_info[3]:
+                project_match = MRS_PROJECT.match(line)
+                if project_match:
+                    ticket_info[3] = project_match.group(1).strip()
+
+            if line.startswith("| Created:"):
+                # test if is bug
+                if not is_bug and "| Class: ER|" in line:
+                    is_bug = True
+
+                # get date of creation
+                if not ticket_info[4]:
+                    created_match = MRS_CREATED.match(line)
+                    if created_match:
+                        ticket_info[4] = created_match.group(1).strip()
+
+            # get assignee (only from the first APS line)
+            if not ticket_info[2]:
+                assignee_match = MRS_ASSIGNEE.match(line)
+                if assignee_match:
+                    ticket_info[2] = assignee_match.group(1).strip()
+
+            # get description
+            if description_stage == 0 and line.startswith(description_start):
+                description_stage = 1
+
+    if not is_bug:
+        return None
+
+    if not ticket_info[0]:
+        logging.warn("Could not parse summary from ticket %s.", ticket_id)
+    if not ticket_info[1]:
+        logging.warn(
+            "Could not parse description from ticket %s", ticket_id)
+    else:
+        ticket_info[1] = ticket_info[1].strip()
+    if not ticket_info[2]:
+        logging.warn("Could not parse assignee from ticket %s", ticket_id)
+
+    return ticket_info
+
+
+class MRSParser(DocumentParser):
+    """Parses MRS data stored in a folder as html files into list of documents.
+    Title of the document is parsed from the header of the file, content is
+    parsed from *Problem Description* section. Label is parsed from the first
+    *Action-By* field which represents the assignee. If Action-By field
+    contains *Unassigned*, the label is replaced by ``None`` object in the
+    ``Document`` object.
+
+    Files are parsed in parallel by a pool of ``processes`` processes. Only
+    files that changed since the last parsing are parsed if ``use_cache`` is
+    set, see :class:`ParseCache`.
+    """
+
+    def __init__(self, folder, project_match=".*", processes=1,
+                 use_cache=True):
+        self.folder = folder
+        self.project_match = project_match
+        self.processes = processes
+        self.use_cache = use_cache
+
+    def parse(self):
+        """Parses data from given folder into list of documents.
+
+        :returns: List of Document objects
+        """
+
+        return list(self.iter_documents())
+
+    def iter_documents(self):
+        """Parses data from given folder and yields the documents one by one
+        in the same order as :meth:`parse` returns them.
+        """
+
+        project_re = re.compile(self.project_match)
+        files = [os.path.join(self.folder, f)
+                 for f in os.listdir(self.folder)
+                 if f not in ['.DS_Store']]  # excluded files
+
+        # Tickets that are not bugs are cached as empty lists
+        cache = ParseCache(self.folder) if self.use_cache else None
+        signatures = [ParseCache.signature(f) for f in files]
+        cached = [cache.get(os.path.basename(f), signature) if cache else None
+                  for f, signature in zip(files, signatures)]
+        missing = [f for f, ticket_info in zip(files, cached)
+                   if ticket_info is None]
+
+        pool = None
+        if self.processes > 1 and missing:
+            pool = multiprocessing.Pool(processes=self.processes)
+            parsed = pool.imap(parse_mrs_file, missing, chunksize=64)
         else:
-            ticket_info[1] = ticket_info[1].strip()
-        if not ticket_info[2]:
-            logging.warn("Could not parse assignee from ticket %s", ticket_id)
+            parsed = itertools.imap(parse_mrs_file, missing)
+
+        try:
+            for f, signature, ticket_info in zip(files, signatures, cached):
+                if ticket_info is None:
+                    ticket_info = next(parsed) or []
+                    if cache:
+                        cache.put(os.path.basename(f), signature, ticket_info)
+
+                if ticket_info and project_re.match(ticket_info[3]):
+                    label = ticket_info[2]
+                    if label == "Unassigned":
+                        label = None
+                    document = Document(ticket_info[0], ticket_info[1], label)
+                    document._created = ticket_info[4]
+                    yield document
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
 
-        return ticket_info
+        if cache:
+            cache.save()
 
     def __str__(self):
         return "MRSParser(folder='%s', project_match='%s')" \
@@ -126,14 +394,28 @@ class BugzillaParser(DocumentParser):
     BUGS_FILE = "bugs"
     COMMENTS_FILE = "latest_comments"
 
-    def __init__(self, folder, label=Label.ASSIGNEE):
+    def __init__(self, folder, label=Label.ASSIGNEE, use_cache=False):
         """Specify folder that contains two files, 'bugs' and 'latest_comments.
+
+        Bugs are streamed, so memory does not grow with the size of the
+        files. If ``use_cache`` is set, parsed bugs are cached (see
+        :class:`ParseCache`) and repeated parsing is fast, but all of them
+        are held in memory.
         """
 
         self.folder = folder
         self.label = label
+        self.use_cache = use_cache
 
     def parse(self):
+        return list(self.iter_documents())
+
+    def iter_documents(self):
+        """Parses the bugs and yields the documents one by one. Bugs are read
+        from the file one at a time and their comments are looked up in the
+        comments file by its index.
+        """
+
         bugsfn = os.path.join(self.folder, self.BUGS_FILE)
         commentsfn = os.path.join(self.folder, self.COMMENTS_FILE)
 
@@ -142,24 +424,32 @@ class BugzillaParser(DocumentParser):
         elif self.label == Label.COMPONENT:
             label_field = "component"
 
-        with open(bugsfn, "r") as bugsf:
-            bugs_raw = bugsf.read()
-        with open(commentsfn, "r") as commentsf:
-            comments_raw = commentsf.read()
-
-        bugs = json.loads(bugs_raw)["bugs"]
-        comments = json.loads(comments_raw)
-
-        documents = []
-        for bug in bugs:
-            title = bug["summary"]
-            description = comments[str(bug["id"])]["comments"]["text"]
-            label = bug[label_field]
-            document = Document(title, description, label)
-            document._created = comments[str(bug["id"])]["comments"]["time"]
-            documents.append(document)
-
-        return documents
+        cache = ParseCache(self.folder) if self.use_cache else None
+        signature = ParseCache.signature(bugsfn, commentsfn)
+        records = cache.get(label_field, signature) if cache else None
+        if records is None:
+            records = self._iter_records(bugsfn, commentsfn, label_field)
+            if cache:
+                records = list(records)
+                cache.put(label_field, signature, records)
+                cache.save()
+
+        return create_documents(records)
+
+    def _iter_records(self, bugsfn, commentsfn, label_field):
+        with open(bugsfn, "rb") as bugsf, open(commentsfn, "rb") as commentsf:
+            comments = JSONObjectIndex(commentsf)
+
+            reader = JSONStreamReader(bugsf)
+            for key in reader.iter_object():
+                if key != "bugs":
+                    reader.read_value()
+                    continue
+
+                for bug in reader.iter_array():
+                    comment = comments[unicode(bug["id"])]["comments"]
+                    yield (bug["summary"], comment["text"], bug[label_field],
+                           comment["time"])
 
     def __str__(self):
         return "BugzillaParser(folder='%s', label='%s')" \
@@ -167,51 +457,111 @@ class BugzillaParser(DocumentParser):
 
 
 class CSVBugzillaParser(DocumentParser):
+    """Parser for bugzilla bugs exported to a CSV file. Title, content and
+    label of the documents are taken from columns at given indices.
+
+    Rows are streamed, so memory does not grow with the size of the file.
+    If ``use_cache`` is set, parsed rows are cached (see :class:`ParseCache`)
+    and repeated parsing is fast, but all of them are held in memory.
+    """
+
     BUGS_FILE = "bugs_with_comments.csv"
 
-    def __init__(self, folder):
+    def __init__(self, folder, title_column=7, content_column=9,
+                 label_column=4, use_cache=False):
         self.folder = folder
+        self.title_column = title_column
+        self.content_column = content_column
+        self.label_column = label_column
+        self.use_cache = use_cache
 
     def parse(self):
-        csv_filepath = os.path.join(self.folder, self.BUGS_FILE)
-        bugs = []
-        with open(csv_filepath, 'rb') as csvf:
-            reader = csv.reader(csvf, delimiter=',')
-            for line in reader:
-                bugs.append(line)
-        bugs = np.array(bugs)
-        documents = []
+        return list(self.iter_documents())
 
-        for bug in bugs:
-            document = Document(bug[7], str(bug[9]), bug[4])
-            documents.append(document)
+    def iter_documents(self):
+        """Parses the CSV file and yields the documents one by one. Only the
+        columns of title, content and label are kept of every row.
+        """
 
-        return documents
+        csv_filepath = os.path.join(self.folder, self.BUGS_FILE)
+        columns = (self.title_column, self.content_column, self.label_column)
+
+        cache = ParseCache(self.folder) if self.use_cache else None
+        cache_key = "%s:%s,%s,%s" % ((self.BUGS_FILE,) + columns)
+        signature = ParseCache.signature(csv_filepath)
+        records = cache.get(cache_key, signature) if cache else None
+        if records is None:
+            records = self._iter_records(csv_filepath, columns)
+            if cache:
+                records = list(records)
+                cache.put(cache_key, signature, records)
+                cache.save()
+
+        return create_documents(records)
+
+    def _iter_records(self, csv_filepath, columns):
+        with open(csv_filepath, 'rb') as csvf:
+            for row in csv.reader(csvf, delimiter=','):
+                yield tuple(row[column] for column in columns)
 
     def __str__(self):
         return "CSVBugzillaParser(folder='%s')" % self.folder
 
 
 class JiraJsonParser(DocumentParser):
-    def __init__(self, folder, project_key="PROJECT"):
+    """Parser for Jira issues exported to JSON files whose names contain the
+    project key.
+
+    Issues are streamed, so memory does not grow with the size of the files.
+    If ``use_cache`` is set, parsed issues are cached (see
+    :class:`ParseCache`) and repeated parsing is fast, but all issues of a
+    file are held in memory.
+    """
+
+    def __init__(self, folder, project_key="PROJECT", use_cache=False):
         self.folder = folder
         self.project_key = project_key
+        self.use_cache = use_cache
 
     def parse(self):
-        issues = []
+        return list(self.iter_documents())
+
+    def iter_documents(self):
+        """Parses the exported issues and yields the documents one by one.
+        Issues are read from the files one at a time.
+        """
+
+        cache = ParseCache(self.folder) if self.use_cache else None
+
         for fn in os.listdir(self.folder):
             filepath = os.path.join(self.folder, fn)
-            if os.path.isfile(filepath) and self.project_key in fn:
-                with open(filepath) as f:
-                    issues += simplejson.load(f)['issues']
-
-        documents = []
-        for issue in issues:
-            doc = Document(issue['fields']['summary'],
-                           issue['fields']['description'],
-                           issue['fields']['assignee']['name'])
-            doc._created = issue['fields']['created']
-            if doc.content or len(doc.title.split()) > 1:
-                documents.append(doc)
-
-        return documents
+            if not os.path.isfile(filepath) or self.project_key not in fn:
+                continue
+
+            signature = ParseCache.signature(filepath)
+            records = cache.get(fn, signature) if cache else None
+            if records is None:
+                records = self._iter_records(filepath)
+                if cache:
+                    records = list(records)
+                    cache.put(fn, signature, records)
+
+            for doc in create_documents(records):
+                if doc.content or len(doc.title.split()) > 1:
+                    yield doc
+
+        if cache:
+            cache.save()
+
+    def _iter_records(self, filepath):
+        with open(filepath, "rb") as f:
+            reader = JSONStreamReader(f)
+            for key in reader.iter_object():
+                if key != "issues":
+                    reader.read_value()
+                    continue
+
+                for issue in reader.iter_array():
+                    fields = issue['fields']
+                    yield (fields['summary'], fields['description'],
+                           fields['assignee']['name'], fields['created'])
@@ -1,91 +1,337 @@
 import os
 import time
+import fcntl
+import errno
+import heapq
+import select
 import signal
 import logging
 
+from Queue import Empty
 from datetime import datetime
-from multiprocessing import Pool
+from multiprocessing import Process, Queue
 from flask.ext.script import Command
 
 from croniter import croniter
-from triager import jobs, db, app
-from models import Project, TrainStatus as TS
+from triager import jobs, storage, db, app
+from models import Project, TrainStatus as TS, TrainingJob, JobStatus
+from models import JobKind, Feedback
+
+
+def get_scheduler_pid():
+    """Returns pid of the running scheduler or ``None`` if the scheduler is
+    not running.
+    """
+
+    scheduler_pid_file = app.config['SCHEDULER_PID_FILE']
+    if not os.path.isfile(scheduler_pid_file):
+        return None
+
+    with open(scheduler_pid_file, 'r') as f:
+        scheduler_pid = int(f.read())
+    try:
+        os.kill(scheduler_pid, 0)
+    except OSError:
+        # Scheduler not running
+        return None
+
+    return scheduler_pid
+
+
+def notify_scheduler():
+    """Tells the running scheduler that some projects were created, changed
+    or deleted, so that it recomputes when they should be trained.
+    """
+
+    scheduler_pid = get_scheduler_pid()
+    if scheduler_pid:
+        os.kill(scheduler_pid, signal.SIGUSR1)
 
 
 class RetrainScheduler(Command):
     DAY = 60*60*24
 
-    def _train_project(self, project):
-        logging.info("Queuing scheduled project %s for training" % project.id)
+    #: Maximum time in seconds the scheduler sleeps without checking if
+    #: any project changed.
+    MAX_SLEEP = 60*60
+
+    def __init__(self):
+        super(RetrainScheduler, self).__init__()
+
+        # Project id -> (schedule, last_training, train_status)
+        self.projects = {}
+        # Project id -> time of next training
+        self.deadlines = {}
+        # Heap of (time of next training, project id), may contain entries
+        # that are no longer valid
+        self.queue = []
+        # Time of the next update of models by confirmed feedback
+        self.next_update = 0
+
+    def _train_project(self, project_id):
+        project = Project.query.get(project_id)
+        job = TrainingJob.enqueue(project_id, jobs.estimate_memory(project))
+        if job is None:
+            logging.info("Project %s already has a training job" % project_id)
+            return
 
+        logging.info("Queuing scheduled project %s for training, estimated "
+                     "memory %.1f MB" % (project_id,
+                                         job.memory_estimate / 1048576.0))
         project.train_status = TS.QUEUED
         db.session.add(project)
         db.session.commit()
 
-        self.pool.apply_async(jobs.train_project, (project.id,))
+        self.job_hints.put(job.id)
+
+    def _update_models(self):
+        """Queues update jobs of trained projects that have feedback confirmed
+        since their models were trained or last updated. Only projects whose
+        published model can be updated are queued, the type of the project
+        may have changed since it was trained. Projects with an active
+        training job are updated after the training.
+        """
+
+        training = db.session.query(TrainingJob.project_id).filter(
+            TrainingJob.kind == JobKind.TRAIN,
+            TrainingJob.status.in_([JobStatus.QUEUED, JobStatus.RUNNING]))
+        projects = db.session.query(Project.id, Project.model_version).join(
+            Feedback, Feedback.project_id == Project.id).filter(
+                Project.train_status == TS.TRAINED,
+                Project.model_version != None,  # noqa
+                ~Project.id.in_(training),
+                Feedback.confirmed > db.func.coalesce(
+                    Project.feedback_until, 0)).distinct()
+
+        for project_id, version in projects.all():
+            manifest = storage.load_manifest(project_id, version)
+            if manifest is None or not manifest.get('updatable'):
+                continue
+
+            job = TrainingJob.enqueue(
+                project_id, app.config['SCHEDULER_MEMORY_BASE'],
+                kind=JobKind.UPDATE)
+            if job is None:
+                continue
+
+            logging.info("Queuing update of project %s by confirmed feedback"
+                         % project_id)
+            db.session.commit()
+            self.job_hints.put(job.id)
+
+    def _get_deadline(self, schedule, last_training, status):
+        nextrun = croniter(schedule, last_training).get_next()
+
+        if not TS.is_active(status):
+            return nextrun
+        elif status == TS.FAILED:
+            # Failed projects are retried a day later
+            return nextrun + self.DAY
+        else:
+            # Queued or training, deadline is computed when training ends
+            return None
+
+    def _update_deadlines(self):
+        """Recomputes deadlines of projects that changed since the last
+        update.
+        """
+
+        db.session.expire_all()
+        current = dict(
+            (project_id, (schedule, last_training, status))
+            for project_id, schedule, last_training, status
+            in db.session.query(Project.id, Project.schedule,
+                                Project.last_training, Project.train_status))
+
+        for project_id in set(self.projects) - set(current):
+            logging.debug("Project %s was deleted" % project_id)
+            del self.projects[project_id]
+            self.deadlines.pop(project_id, None)
+
+        for project_id, state in current.items():
+            if self.projects.get(project_id) == state:
+                continue
+
+            self.projects[project_id] = state
+            deadline = self._get_deadline(*state)
+            if deadline is None:
+                self.deadlines.pop(project_id, None)
+                continue
+
+            self.deadlines[project_id] = deadline
+            heapq.heappush(self.queue, (deadline, project_id))
+            logging.debug("Project %s next build %s" % (
+                project_id, datetime.fromtimestamp(deadline).strftime(
+                    '%Y-%m-%d %H:%M:%S')))
 
     def _retrain_loop(self):
         while True:
-            projects = Project.query
-
-            logging.debug("Found %s projects" % projects.count())
-            for project in projects:
-                logging.debug("Checking if project %s needs training"
-                              % project.id)
-
-                crontab = croniter(project.schedule, project.last_training)
-                nextrun = crontab.get_next()
-                status = project.train_status
-
-                p_format = '%Y-%m-%d %H:%M:%S'
-                p_last_training = datetime.fromtimestamp(
-                    project.last_training).strftime(p_format)
-                p_nextrun = datetime.fromtimestamp(
-                    nextrun).strftime(p_format)
-
-                logging.debug("Project %s last build %s, next build %s"
-                              % (project.id, p_last_training, p_nextrun))
-
-                if nextrun <= time.time():
-                    if not TS.is_active(status):
-                        logging.info("Project %s is not in an active status"
-                                     % project.id)
-                        self._train_project(project)
-                    elif status == TS.FAILED and \
-                            nextrun + self.DAY <= time.time():
-                        logging.warning(
-                            "Project %s failed a day ago, trying again"
-                            % project.id)
-                        self._train_project(project)
-
-            db.session.expire_all()
-            time.sleep(60)
-
-    def _pool_init(self):
+            self._check_workers()
+            self._update_deadlines()
+
+            now = time.time()
+            while self.queue and self.queue[0][0] <= now:
+                deadline, project_id = heapq.heappop(self.queue)
+                if self.deadlines.get(project_id) != deadline:
+                    # Deadline was recomputed or project deleted
+                    continue
+
+                del self.deadlines[project_id]
+                self._train_project(project_id)
+
+            if self.next_update <= now:
+                self._update_models()
+                self.next_update = \
+                    now + app.config['SCHEDULER_UPDATE_INTERVAL']
+
+            timeout = min(self.MAX_SLEEP, self.next_update - now)
+            if self.queue:
+                timeout = min(max(self.queue[0][0] - now, 0), timeout)
+            self._sleep(timeout)
+
+    def _sleep(self, timeout):
+        """Sleeps until the timeout expires or the scheduler is woken up."""
+
+        try:
+            readable, _, _ = select.select(
+                [self.wakeup_pipe[0]], [], [], timeout)
+        except select.error as ex:
+            if ex.args[0] != errno.EINTR:
+                raise
+            return
+
+        if readable:
+            os.read(self.wakeup_pipe[0], 1024)
+
+    def _wakeup(self, *args):
+        try:
+            os.write(self.wakeup_pipe[1], "\0")
+        except OSError as ex:
+            # Pipe is full, the scheduler will wake up anyway
+            if ex.errno != errno.EAGAIN:
+                raise
+
+    def _check_workers(self):
+        """Replaces workers that died and requeues their jobs."""
+
+        dead_workers = [w for w in self.workers if not w.is_alive()]
+        if not dead_workers:
+            return
+
+        for worker in dead_workers:
+            logging.warning("Worker %s died with exit code %s"
+                            % (worker.pid, worker.exitcode))
+            self.workers.remove(worker)
+            self._start_worker()
+        TrainingJob.recover()
+
+    def _start_worker(self):
+        worker = Process(target=self._worker, args=(os.getpid(),))
+        worker.start()
+        self.workers.append(worker)
+
+    def _worker(self, scheduler_pid):
         signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGUSR1, signal.SIG_IGN)
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+
+        # Database connections must not be shared with the scheduler
+        db.session.remove()
+        db.engine.dispose()
+
+        worker_pid = os.getpid()
+        # Stop when the scheduler is gone
+        while os.getppid() == scheduler_pid:
+            job = TrainingJob.claim(
+                worker_pid, memory_limit=app.config['SCHEDULER_MEMORY_LIMIT'])
+            if job is None:
+                try:
+                    self.job_hints.get(
+                        timeout=app.config['SCHEDULER_POLL_INTERVAL'])
+                except Empty:
+                    pass
+                continue
+
+            logging.info("Worker %s claimed job %s of project %s (attempt %s)"
+                         % (worker_pid, job.id, job.project_id, job.attempts))
+
+            # Every job runs in a new process, so that its peak memory can be
+            # measured and the memory is returned to the system afterwards
+            job_process = Process(target=self._run_job, args=(job.id,))
+            job_process.start()
+            job_process.join()
+
+            if job_process.exitcode != 0:
+                logging.error("Training process of job %s exited with code "
+                              "%s" % (job.id, job_process.exitcode))
+                db.session.expire_all()
+                job = TrainingJob.query.get(job.id)
+                if job and job.status == JobStatus.RUNNING:
+                    jobs.finish_job(
+                        job, False, "Reason: Training process exited with "
+                        "code %s" % job_process.exitcode)
+
+            # Let the scheduler know that the project changed
+            os.kill(scheduler_pid, signal.SIGUSR1)
+
+    def _run_job(self, job_id):
+        db.session.remove()
+        db.engine.dispose()
+
+        jobs.run_job(job_id)
 
     def run(self):
+        # Wake up when a project is changed, training finishes or a worker
+        # dies. Handlers must be installed before the pid file is written,
+        # otherwise SIGUSR1 of notify_scheduler would terminate the scheduler.
+        self.wakeup_pipe = os.pipe()
+        for fd in self.wakeup_pipe:
+            flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        for signum in [signal.SIGUSR1, signal.SIGCHLD]:
+            signal.signal(signum, self._wakeup)
+            # Restart interrupted system calls other than select
+            signal.siginterrupt(signum, False)
+
         # Save scheduler.pid in data directory
         with open(app.config['SCHEDULER_PID_FILE'], 'w') as f:
             f.write(str(os.getpid()))
 
-        # Check projects that are in QUEUED and TRAINING statues and move
-        # them to FAILED
+        # Resume jobs that were interrupted when the scheduler stopped.
+        # Projects in QUEUED and TRAINING statuses without any job are moved
+        # to FAILED.
+        TrainingJob.recover()
+        active_jobs = set(
+            project_id for project_id, in db.session.query(
+                TrainingJob.project_id).filter(
+                    TrainingJob.kind == JobKind.TRAIN,
+                    TrainingJob.status.in_(
+                        [JobStatus.QUEUED, JobStatus.RUNNING])))
+
         projects = Project.query
         for project in projects:
-            if project.train_status in [TS.QUEUED, TS.TRAINING]:
+            if project.train_status not in [TS.QUEUED, TS.TRAINING]:
+                continue
+
+            if project.id in active_jobs:
+                logging.info("Resuming training job of project %s"
+                             % project.id)
+                project.train_status = TS.QUEUED
+            else:
                 logging.warning("Project %s in state '%s' on scheduler startup"
                                 % (project.id, project.train_status))
                 project.train_status = TS.FAILED
                 project.training_message = \
                     "Reason: Scheduler stopped unexpectedly"
-                db.session.add(project)
-        else:
-            db.session.commit()
+            db.session.add(project)
+        db.session.commit()
 
-        # Create new pool
-        self.pool = Pool(processes=app.config['SCHEDULER_PROCESSES'],
-                         initializer=self._pool_init)
+        # Start workers, they are not daemonic, so that they can evaluate
+        # models in their own process pools
+        self.job_hints = Queue()
+        self.workers = []
+        for _ in range(app.config['SCHEDULER_PROCESSES']):
+            self._start_worker()
 
         # Start infinite loop
         try:
@@ -93,5 +339,7 @@ class RetrainScheduler(Command):
         except KeyboardInterrupt:
             logging.warning(
                 "Keybord interrupt detected, terminating scheduler.")
-            self.pool.terminate()
-            self.pool.join()
+            for worker in self.workers:
+                worker.terminate()
+            for worker in self.workers:
+                worker.join()
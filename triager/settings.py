@@ -13,6 +13,63 @@ MODEL_FOLDER = os.path.join(STORAGE_FOLDER, 'model')
 SCHEDULER_PID_FILE = os.path.join(STORAGE_FOLDER, 'scheduler.pid')
 SCHEDULER_PROCESSES = 3
 
+#: How many times a failed training job is attempted and the delay in seconds
+#: before the first retry, the delay doubles with every other retry.
+SCHEDULER_MAX_ATTEMPTS = 3
+SCHEDULER_RETRY_DELAY = 10*60
+
+#: Memory in bytes that training jobs running at the same time can use. A job
+#: is started only if its estimated memory fits the limit. Memory of a job is
+#: estimated from the base memory of a worker, the number of documents of the
+#: project, memory per document of each model type and the SVM cache size.
+#: Estimates above the limit are lowered to the limit.
+SCHEDULER_MEMORY_LIMIT = 4*1024*1024*1024
+SCHEDULER_MEMORY_BASE = 200*1024*1024
+SCHEDULER_MEMORY_PER_DOCUMENT = {'svm': 20*1024, 'linear': 2*1024}
+
+#: Maximum time in seconds an idle worker waits before it checks for jobs
+#: that are ready to be retried.
+SCHEDULER_POLL_INTERVAL = 60
+
+#: Interval in seconds of updates of linear models by confirmed feedback
+#: between their trainings.
+SCHEDULER_UPDATE_INTERVAL = 10*60
+
+#: Number of the last trainings of each project whose stage durations are
+#: kept, histograms of the durations cover all trainings.
+TRAINING_RUNS_KEPT = 100
+
+#: Maximum size (in bytes) of trained models kept in memory by each web
+#: worker. Least recently used models are evicted first.
+MODEL_CACHE_SIZE = 1024*1024*1024
+
+#: Number of the last trained versions of a model of each project kept on
+#: disk, older versions can be published again by *rollback* command.
+MODEL_VERSIONS_KEPT = 3
+
+#: Maximum number of predictions kept in memory by each web worker, so that
+#: the same issue submitted again is not predicted again.
+PREDICTION_CACHE_SIZE = 10000
+
+#: Evaluation: number of cross-validation folds, number of processes that
+#: train the folds in parallel, seed of the random split of the data and
+#: maximum time in seconds the evaluation of one project can take.
+EVALUATION_FOLDS = 5
+EVALUATION_PROCESSES = 2
+EVALUATION_SEED = 42
+EVALUATION_TIMEOUT = 60*60
+
+#: Jira client: number of pages of search results downloaded in parallel and
+#: number of retries of a failed request.
+JIRA_CONCURRENCY = 4
+JIRA_RETRIES = 3
+
+#: Interval in seconds of full synchronizations of Jira data sources. Issues
+#: that no longer match the query of the data source (e.g. reopened or
+#: unassigned) are removed from the local issue store only by a full
+#: synchronization.
+JIRA_FULL_SYNC_INTERVAL = 7*24*60*60
+
 #: Logging level.
 LOG_LEVEL = logging.DEBUG if DEBUG else logging.INFO
 
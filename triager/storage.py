@@ -0,0 +1,142 @@
+import os
+import json
+import time
+import errno
+import shutil
+import joblib
+
+from triager import app
+from cache import ModelCache
+
+
+MANIFEST_FILE = "manifest.json"
+
+#: Name of the symbolic link to the directory of the published version
+CURRENT_LINK = "current"
+
+#: Version of the format of saved models, models saved in other formats
+#: are trained again even if their data did not change.
+MODEL_FORMAT = 6
+
+
+def get_model_dir(project_id):
+    return os.path.join(app.config['MODEL_FOLDER'], str(project_id))
+
+
+def get_version_dir(project_id, version=None):
+    """Returns directory of given version of the model of the project, or of
+    the published version if no version is given.
+    """
+
+    if version is None:
+        version = CURRENT_LINK
+    return os.path.join(get_model_dir(project_id), str(version))
+
+
+def get_manifest_path(project_id, version=None):
+    return os.path.join(get_version_dir(project_id, version), MANIFEST_FILE)
+
+
+def get_versions(project_id):
+    """Returns sorted list of saved versions of the model of the project."""
+
+    try:
+        names = os.listdir(get_model_dir(project_id))
+    except OSError:
+        return []
+    return sorted(int(name) for name in names if name.isdigit())
+
+
+def save_model(project_id, model, **details):
+    """Saves trained model of the project as a new version together with its
+    manifest. The manifest contains version of the model, time of the
+    training, details of the model (see :meth:`classifiers.SVMModel.details`),
+    size of the model file and any other given details. The version is not
+    used until it is published by :func:`publish`.
+
+    :returns: The manifest.
+    """
+
+    trained_at = time.time()
+    version = int(trained_at * 1000)
+    version_dir = get_version_dir(project_id, version)
+    os.makedirs(version_dir)
+
+    # Arrays of the model are stored uncompressed, so that they can be
+    # memory mapped and shared by all the processes that load the model
+    model_path = os.path.join(version_dir, ModelCache.MODEL_FILE)
+    joblib.dump(model, model_path, compress=0)
+
+    manifest = dict(version=version, trained_at=trained_at,
+                    format=MODEL_FORMAT,
+                    file_size=os.path.getsize(model_path))
+    manifest.update(model.details())
+    manifest.update(details)
+
+    with open(get_manifest_path(project_id, version), 'w') as f:
+        json.dump(manifest, f)
+
+    return manifest
+
+
+def publish(project_id, version):
+    """Publishes given version of the model of the project by atomically
+    switching the *current* link to its directory. Only the last
+    ``MODEL_VERSIONS_KEPT`` versions and the published version are kept.
+    """
+
+    model_dir = get_model_dir(project_id)
+    link_path = get_version_dir(project_id)
+    tmp_link_path = link_path + ".tmp"
+    try:
+        os.remove(tmp_link_path)
+    except OSError as ex:
+        if ex.errno != errno.ENOENT:
+            raise
+    os.symlink(str(version), tmp_link_path)
+    os.rename(tmp_link_path, link_path)
+
+    # Files of removed versions stay readable by the processes that have
+    # them memory mapped
+    versions = get_versions(project_id)
+    for old_version in versions[:-app.config['MODEL_VERSIONS_KEPT']]:
+        if old_version != version:
+            shutil.rmtree(os.path.join(model_dir, str(old_version)),
+                          ignore_errors=True)
+
+
+def discard(project_id, version):
+    """Removes given unpublished version of the model of the project."""
+
+    shutil.rmtree(get_version_dir(project_id, version), ignore_errors=True)
+
+
+def get_previous_version(project_id, version):
+    """Returns the newest saved version older than given version, or
+    ``None`` if there is no such version.
+    """
+
+    older = [v for v in get_versions(project_id) if v < version]
+    return older[-1] if older else None
+
+
+def load_model(project_id, version):
+    """Loads given version of the model of the project into memory, so that
+    it can be modified.
+    """
+
+    return joblib.load(os.path.join(get_version_dir(project_id, version),
+                                    ModelCache.MODEL_FILE))
+
+
+def load_manifest(project_id, version=None):
+    """Returns manifest of given version of the model of the project, or of
+    the published version if no version is given. ``None`` is returned if
+    there is no such version.
+    """
+
+    try:
+        with open(get_manifest_path(project_id, version), 'r') as f:
+            return json.load(f)
+    except IOError:
+        return None
@@ -1,5 +1,89 @@
+import os
 import hashlib
 
 
 def hash_pwd(password):
     return hashlib.sha512(password).hexdigest()
+
+
+def fingerprint(documents, *values):
+    """Returns digest of the documents and other values that affect a
+    trained model. It is used to detect that the model would not change if
+    it was trained again.
+    """
+
+    digest = hashlib.sha1()
+    for value in values:
+        digest.update(repr(value) + "\0")
+    for document in documents:
+        for field in (document.title, document.content, document.label):
+            digest.update((field or u"").encode("utf-8") + "\0")
+
+    return digest.hexdigest()
+
+
+def get_process_token(pid):
+    """Returns string that identifies the running process with given pid,
+    so that a process that reuses the pid later, even after a reboot, is not
+    mistaken for it. ``None`` is returned if no process has the pid.
+
+    Boot id and start time of the process are used where ``/proc`` is
+    available, elsewhere only the pid is.
+    """
+
+    try:
+        with open("/proc/%s/stat" % pid, 'r') as f:
+            stat = f.read()
+        with open("/proc/sys/kernel/random/boot_id", 'r') as f:
+            boot_id = f.read().strip()
+    except IOError:
+        if os.path.isdir("/proc/self"):
+            # The process does not exist
+            return None
+        try:
+            os.kill(pid, 0)
+        except OSError:
+            return None
+        return str(pid)
+
+    # Name of the process in parentheses may contain spaces, start time is
+    # the 20th field after it
+    start_time = stat[stat.rindex(")") + 2:].split()[19]
+    return "%s:%s:%s" % (boot_id, pid, start_time)
+
+
+def get_tree_memory(pid):
+    """Returns resident memory in bytes of the process with given pid and
+    all its descendants, or ``None`` if ``/proc`` is not available. Pages
+    shared by the processes are counted once for each of them.
+    """
+
+    try:
+        pids = [p for p in os.listdir("/proc") if p.isdigit()]
+    except OSError:
+        return None
+
+    children = {}
+    for child in pids:
+        try:
+            with open("/proc/%s/stat" % child, 'r') as f:
+                stat = f.read()
+        except IOError:
+            # The process has already exited
+            continue
+        # Parent pid is the 2nd field after the name of the process
+        parent = stat[stat.rindex(")") + 2:].split()[1]
+        children.setdefault(parent, []).append(child)
+
+    page_size = os.sysconf("SC_PAGE_SIZE")
+    memory = 0
+    pending = [str(pid)]
+    while pending:
+        process = pending.pop()
+        pending.extend(children.get(process, ()))
+        try:
+            with open("/proc/%s/statm" % process, 'r') as f:
+                memory += int(f.read().split()[1]) * page_size
+        except IOError:
+            continue
+    return memory
@@ -1,21 +1,28 @@
-import os
+import csv
+import time
+import logging
 import shutil
-import joblib
 
 import models
+import storage
 
+from io import BytesIO
+from datetime import datetime
 from classifier import tests
 from classifier.document import Document
 from flask import render_template, flash, redirect, url_for
-from flask import jsonify, make_response, request
+from flask import jsonify, request, Response, stream_with_context
 from flask.ext.login import login_user, login_required, logout_user
 
-from triager import app, db, config
-from models import Project, TrainStatus as TS, Feedback
+from triager import app, db, config, model_cache, prediction_cache
+from triager import prediction_metrics
+from models import Project, TrainStatus as TS, Feedback, TrainingJob
+from models import TrainingRun, TrainingMetric
 from forms import ProjectForm, IssueForm, DataSourceForm, ConfigurationForm
 from forms import LoginForm, FeedbackForm
 from auth import User
 from utils import hash_pwd
+from schedulers import get_scheduler_pid, notify_scheduler
 
 
 @app.route("/")
@@ -76,23 +83,27 @@ def view_project(id):
     form = IssueForm()
     feedback_form = FeedbackForm()
     predictions = []
-    model_path = os.path.join(app.config['MODEL_FOLDER'], '%s/svm.pkl' % id)
-    trained = project.train_status != TS.NOT_TRAINED \
-        and os.path.isfile(model_path)
+    manifest = None
+    if project.train_status != TS.NOT_TRAINED \
+            and project.model_version is not None:
+        manifest = storage.load_manifest(id, project.model_version)
+    trained = manifest is not None
+    last_run = TrainingRun.query \
+        .filter_by(project_id=project.id, skipped=False) \
+        .order_by(TrainingRun.id.desc()).first()
     summary_or_description = form.summary.data or form.description.data
 
     if trained and form.validate_on_submit() and summary_or_description:
         issue = Document(form.summary.data, form.description.data)
-        model = joblib.load(model_path)
-        try:
-            predictions = model.predict(issue, n=10)
-        except ValueError:
+        predictions = [label for label, _ in _predict(project, [issue])[0]]
+        if not predictions:
             flash("There is too little information provided. "
                   "You need to add more text to the description or summary.",
                   "error")
 
         feedback_form.summary.data = form.summary.data
         feedback_form.description.data = form.description.data
+        feedback_form.model_version.data = project.model_version
         existing_feedback = Feedback.query.get(
             Feedback.get_id_from_doc(issue, project=project))
         if existing_feedback:
@@ -107,6 +118,7 @@ def view_project(id):
     fscore = tests.fscore(project.precision, project.recall)
     return render_template("project/view.html", project=project, fscore=fscore,
                            form=form, predictions=predictions, trained=trained,
+                           manifest=manifest, last_run=last_run,
                            feedback_form=feedback_form)
 
 
@@ -134,6 +146,7 @@ def create_project():
 
             db.session.add(new_project)
             db.session.commit()
+            notify_scheduler()
             flash("New project successfully created.")
             return redirect(url_for('view_project', id=new_project.id))
 
@@ -163,11 +176,21 @@ def edit_project(id):
         ds_form = ds_forms[form.datasource_type.data]
 
         if ds_form.validate():
-            project.datasource = getattr(models, form.datasource_type.data)()
-            ds_form.populate_obj(project.datasource)
+            old_datasource = project.datasource
+            if form.datasource_type.data != current_ds_type \
+                    or _datasource_changed(old_datasource, ds_form):
+                project.datasource = \
+                    getattr(models, form.datasource_type.data)()
+                ds_form.populate_obj(project.datasource)
+
+                # Locally stored data of the old data source are of no use
+                # now
+                old_datasource.clear_data()
+                db.session.delete(old_datasource)
 
             db.session.add(project)
             db.session.commit()
+            notify_scheduler()
             flash("Project %s successfully updated." % project.name)
             return redirect(url_for('view_project', id=project.id))
 
@@ -175,18 +198,37 @@ def edit_project(id):
                            form=form, ds_forms=ds_forms, project=project)
 
 
+def _datasource_changed(datasource, ds_form):
+    """Returns ``True`` if data of the form differ from the data source."""
+
+    for name, field in ds_form._fields.items():
+        if name == "csrf_token":
+            continue
+        if (field.data or None) != (getattr(datasource, name) or None):
+            return True
+    return False
+
+
 @app.route("/project/<id>/delete", methods=['POST'])
 @login_required
 def delete_project(id):
     project = Project.query.get_or_404(id)
 
     # Delete project form database
+    TrainingJob.query.filter_by(project_id=project.id).delete()
+    TrainingRun.query.filter_by(project_id=project.id).delete()
+    TrainingMetric.query.filter_by(project_id=project.id).delete()
+    if project.datasource:
+        project.datasource.clear_data()
+        db.session.delete(project.datasource)
     db.session.delete(project)
     db.session.commit()
+    notify_scheduler()
 
     # Remove model data
-    model_dir = os.path.join(app.config['MODEL_FOLDER'], str(id))
+    model_dir = storage.get_model_dir(id)
     shutil.rmtree(model_dir, ignore_errors=True)
+    model_cache.evict(id)
 
     flash("Project %s successfully deleted." % project.name)
     return redirect(url_for('homepage'))
@@ -212,6 +254,14 @@ def post_feedback(id):
         if form.confirmed_recommendation.data:
             feedback.confirmed_recommendation = \
                 form.confirmed_recommendation.data
+            # Remember the confirmed assignee, so that the model can be
+            # updated by the issue before it is trained again
+            feedback.summary = issue.title
+            feedback.description = issue.content
+            feedback.confirmed_label = _get_confirmed_label(
+                project, issue, feedback.confirmed_recommendation,
+                form.model_version.data, form.confirmed_assignee.data)
+            feedback.confirmed = time.time()
         db.session.add(feedback)
         db.session.commit()
 
@@ -219,23 +269,232 @@ def post_feedback(id):
 
     return jsonify(result="error", errors=form.errors), 400
 
+
+def _get_confirmed_label(project, issue, recommendation, version,
+                         assignee):
+    """Returns the assignee of the confirmed recommendation of the issue, or
+    ``None`` if none of the recommendations was correct. Recommendations are
+    predicted again by the model version that recommended them, the
+    assignee is returned only if it is the one that was confirmed.
+    """
+
+    try:
+        version = int(version)
+    except (TypeError, ValueError):
+        return None
+
+    results = _predict(project, [issue], version=version)
+    if results is None:
+        logging.warning("Confirmation of project %s is not used to update "
+                        "the model, version %s no longer exists"
+                        % (project.id, version))
+        return None
+    if not results or not 0 < recommendation <= len(results[0]):
+        return None
+
+    label = results[0][recommendation - 1][0]
+    if label != assignee:
+        return None
+    return label
+
+
+@app.route("/api/project/<id>/model")
+def api_model(id):
+    """Returns manifest of trained model of the project."""
+
+    project = Project.query.get_or_404(id)
+
+    manifest = None
+    if project.model_version is not None:
+        manifest = storage.load_manifest(id, project.model_version)
+    if manifest is None:
+        return jsonify(result="error",
+                       errors=["Project is not trained yet."]), 409
+
+    return jsonify(result="success", model=manifest)
+
+
+@app.route("/api/project/<id>/predict", methods=['POST'])
+def api_predict(id):
+    """Predicts assignees of a batch of issues. Request body must be a JSON
+    array of objects with *summary* and *description* fields. Number of
+    returned assignees for each issue can be set by *n* query parameter.
+    """
+
+    project = Project.query.get_or_404(id)
+
+    n = request.args.get("n", 10, type=int)
+    if n < 1:
+        return jsonify(result="error",
+                       errors=["Parameter n must be a positive integer."]), 400
+
+    issues = request.get_json(silent=True)
+    if not isinstance(issues, list):
+        return jsonify(result="error",
+                       errors=["Request body must be a JSON array."]), 400
+
+    documents = []
+    for issue in issues:
+        if not isinstance(issue, dict) \
+                or not (issue.get("summary") or issue.get("description")):
+            return jsonify(result="error", errors=[
+                "Summary or description must not be empty."]), 400
+        if not all(isinstance(issue.get(field) or "", basestring)
+                   for field in ("summary", "description")):
+            return jsonify(result="error", errors=[
+                "Summary and description must be strings."]), 400
+        documents.append(
+            Document(issue.get("summary"), issue.get("description")))
+
+    results = None
+    if project.train_status != TS.NOT_TRAINED:
+        results = _predict(project, documents, n=n)
+    if results is None:
+        return jsonify(result="error",
+                       errors=["Project is not trained yet."]), 409
+
+    predictions = []
+    for scores in results:
+        predictions.append([dict(assignee=label, score=score)
+                            for label, score in scores])
+
+    return jsonify(result="success", predictions=predictions)
+
+
+def _predict(project, documents, n=10, version=None):
+    """Predicts ``n`` most likely assignees of each of the documents by the
+    model of the project, or by given version of the model. Predictions of
+    documents that were predicted recently by the same model are taken from
+    the prediction cache, the rest is predicted in a single batch. Versions
+    other than the published one are loaded without replacing the published
+    model in the model cache.
+
+    :returns: List that contains a list of ``(label, score)`` tuples for each
+              document, the list is empty if the document contains no known
+              features. ``None`` if the project has no trained model or
+              the version no longer exists.
+    """
+
+    if version is None:
+        version = project.model_version
+    if version is None:
+        return None
+
+    if n > prediction_cache.n:
+        # Cached predictions are too short
+        model = _load_model(project, version)
+        if model is None:
+            return None
+        return [scores or [] for scores
+                in _predict_scores(project, model, documents, n)]
+
+    digests = [Feedback.get_id_from_doc(doc, project=project)
+               for doc in documents]
+    results = [prediction_cache.get(digest, version) for digest in digests]
+
+    missing = [i for i, scores in enumerate(results) if scores is None]
+    if missing:
+        model = _load_model(project, version)
+        if model is None:
+            return None
+        predicted = _predict_scores(
+            project, model, [documents[i] for i in missing],
+            prediction_cache.n)
+        for i, scores in zip(missing, predicted):
+            prediction_cache.put(digests[i], version, scores)
+            results[i] = scores or []
+
+    return [scores[:n] for scores in results]
+
+
+def _load_model(project, version):
+    with prediction_metrics.time(project.id, "load"):
+        if version == project.model_version:
+            return model_cache.get(project.id, version)
+        return model_cache.load(project.id, version)
+
+
+def _predict_scores(project, model, documents, n):
+    with prediction_metrics.time(project.id, "featurize"):
+        X = model.transform(documents)
+    with prediction_metrics.time(project.id, "predict"):
+        return model.predict_scores_features(X, n)
+
+
+@app.route("/metrics")
+def metrics():
+    """Exposes histograms of durations of predictions of this web worker and
+    of stages of trainings of all projects in the Prometheus text format.
+    """
+
+    histograms = [prediction_metrics] + TrainingRun.histograms()
+    return Response("".join(h.expose() for h in histograms),
+                    mimetype="text/plain; version=0.0.4")
+
+
 @app.route("/feedback.csv")
 def feedback_csv():
-    all_feedback = Feedback.query
-    csv_vals = "project_id,selected,confirmed,accuracy,precision,recall\n"
-    for feedback in all_feedback:
-        csv_vals += "%s,%s,%s,%4.4f,%4.4f,%4.4f\n" \
-            % (feedback.project.id, feedback.selected_recommendation,
-               feedback.confirmed_recommendation, feedback.project.accuracy,
-               feedback.project.precision, feedback.project.recall)
-
-    resp = make_response(csv_vals)
+    """Exports feedback as CSV. Export can be limited to a single project by
+    *project_id* query parameter and to feedback given in a date range by
+    *since* and *until* query parameters in format YYYY-MM-DD (both
+    inclusive).
+    """
+
+    query = db.session.query(
+        Feedback.project_id, Feedback.selected_recommendation,
+        Feedback.confirmed_recommendation, Project.accuracy,
+        Project.precision, Project.recall) \
+        .join(Project, Feedback.project_id == Project.id)
+
+    project_id = request.args.get("project_id")
+    if project_id:
+        query = query.filter(Feedback.project_id == project_id)
+
+    try:
+        since = _parse_date(request.args.get("since"))
+        until = _parse_date(request.args.get("until"))
+    except ValueError:
+        return jsonify(result="error", errors=[
+            "Dates must be in format YYYY-MM-DD."]), 400
+    if since is not None:
+        query = query.filter(Feedback.created >= since)
+    if until is not None:
+        query = query.filter(Feedback.created < until + 24*60*60)
+
+    query = query.order_by(Feedback.project_id).yield_per(1000)
+
+    def generate():
+        buf = BytesIO()
+        writer = csv.writer(buf, lineterminator="\n")
+        writer.writerow(["project_id", "selected", "confirmed", "accuracy",
+                         "precision", "recall"])
+        for i, (project_id, selected, confirmed, accuracy, precision,
+                recall) in enumerate(query, 1):
+            writer.writerow([project_id, selected, confirmed,
+                             "%4.4f" % accuracy, "%4.4f" % precision,
+                             "%4.4f" % recall])
+            if i % 1000 == 0:
+                yield buf.getvalue()
+                buf.seek(0)
+                buf.truncate()
+        yield buf.getvalue()
+
     if request.args.get("plain"):
-        resp.mimetype = "text/plain"
+        mimetype = "text/plain"
     else:
-        resp.mimetype = "text/csv"
+        mimetype = "text/csv"
+
+    return Response(stream_with_context(generate()), mimetype=mimetype)
+
+
+def _parse_date(value):
+    """Returns timestamp of the start of the date in local time, or ``None``
+    if no date is given.
+    """
 
-    return resp
+    if not value:
+        return None
+    return time.mktime(datetime.strptime(value, "%Y-%m-%d").timetuple())
 
 
 #
@@ -249,17 +508,4 @@ def all_projects():
 
 @app.context_processor
 def scheduler_running_check():
-    result = dict(is_scheduler_running=False)
-    scheduler_pid_file = app.config['SCHEDULER_PID_FILE']
-
-    if os.path.isfile(scheduler_pid_file):
-        with open(scheduler_pid_file, 'r') as f:
-            scheduler_pid = int(f.read())
-        try:
-            os.kill(scheduler_pid, 0)
-            result['is_scheduler_running'] = True
-        except OSError:
-            # Scheduler not running
-            pass
-
-    return result
+    return dict(is_scheduler_running=get_scheduler_pid() is not None)